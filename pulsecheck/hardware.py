@@ -1,7 +1,6 @@
-from fifo import Fifo # type: ignore
-from lib.peripherals import Button, Rotary, Screen, Isr_fifo
+from lib.peripherals import Button, Rotary, Screen, Isr_fifo, WakingFifo
 from led import Led # type: ignore
-from lib.utility import read_wifi_file
+from lib.utility import read_wifi_file, read_worst_pass
 from lib.historian import History
 from lib.online import Online
 '''This file contains the hardware object and the initizaliati'''
@@ -32,14 +31,15 @@ class HardwareConfig:
             self.ADC = 26
             self.SW0 = 7
 
-            #Create fifo for input events, signed short needed for rotary
-            self.fifo = Fifo(50, 'h')
+            #Create fifo for input events, signed short needed for rotary. Wakes the asyncio runtime if it is used
+            self.fifo = WakingFifo(50, 'h')
 
-            #Create the historian for local saving
-            self.historian = History()
+            settings = read_wifi_file()
+
+            #Create the historian for local saving, HISTORY_KB and PPI_KB in settings.txt are the flash it may use
+            self.historian = History(int(settings.get('HISTORY_KB', History.BUDGET_KB)), int(settings.get('PPI_KB', History.PPI_KB)))
 
             #Create online communications object
-            settings = read_wifi_file()
             self.online = Online(settings['SSID'], settings['PASSWORD'], settings['MQTTBROKER'], settings['TOPIC'], settings['PORT'])
 
             #Create hardware objects
@@ -48,4 +48,13 @@ class HardwareConfig:
             self.rotary = Rotary(self.ROTA, self.ROTB, self.fifo)
             self.screen = Screen(self.OLED_DA, self.OLED_CLK)
             self.led1 = Led(self.LED1)
-            self.adc = Isr_fifo(10, self.ADC)
+
+            #LED1 is on while connected, the connection is kept up in the background
+            self.online.on_event(lambda event: self.led1.on() if event == 'connected' else self.led1.off())
+
+            #ADC sampling, the fifo must hold every sample that arrives during the worst state machine pass.
+            #The measuring states save a worse pass than this when they see one, the fifo is sized for it on the next boot.
+            #120 ms until one is measured, at most 1000 ms (1 kB of fifo)
+            self.ADC_HZ = 250
+            self.WORST_PASS_MS = min(read_worst_pass(120), 1000)
+            self.adc = Isr_fifo(Isr_fifo.size_for(self.ADC_HZ, self.WORST_PASS_MS), self.ADC)
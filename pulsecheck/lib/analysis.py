@@ -1,5 +1,6 @@
-from math import sqrt
+from math import sqrt, cos, sin, pi
 from time import mktime, localtime
+from array import array
 
 '''This file contains all mathematical functions for calculating the HRV parameters locally'''
 
@@ -43,19 +44,435 @@ def preprocess_ppi(ppi: list, percent: float = 0.2) -> list:
       ppi = [i for i in ppi if low < i < up]
       return ppi
 
+#Same PPI as preprocess_ppi without building a list, so a stored PpiSeries is read from flash instead of decoded into RAM.
+#Can be iterated many times and has a length like the series, the analysis functions below only iterate what they get
+class Within:
+      def __init__(self, ppi: list, percent: float = 0.2):
+            self.ppi = ppi
+            average = mean_ppi(ppi)
+            self.low = average*(1-percent)
+            self.up = average*(1+percent)
+            self.count = 0
+            for _ in self:
+                  self.count += 1
+
+      def __len__(self) -> int:
+            return self.count
+
+      def __iter__(self):
+            for rr in self.ppi:
+                  if self.low < rr < self.up:
+                        yield rr
+
+#Frequency domain, the PPI series is resampled evenly at 4 Hz, detrended, Hann windowed and FFT'd.
+#Bands in Hz like Kubios, powers in ms^2
+RESAMPLE_HZ = 4
+MAX_FFT = 512 #Over 2 minutes at 4 Hz, longer series use the newest part
+SPLINE_MARGIN_MS = 5000 #Beats kept before the used part of a longer series, the spline settles in a few beats
+LF_HF_MAX = 100.0 #A flat HF band makes the ratio meaningless, it is capped so it stays one
+LF_BAND = (0.04, 0.15)
+HF_BAND = (0.15, 0.4)
+_tables = {} #FFT size: (cos, sin, bit reverse), made once per size
+
+def _fft_tables(n: int) -> tuple:
+      if n not in _tables:
+            cos_t = array('f', (cos(2*pi*k/n) for k in range(n//2)))
+            sin_t = array('f', (-sin(2*pi*k/n) for k in range(n//2)))
+            bits = 0
+            while (1 << bits) < n:
+                  bits += 1
+            rev = array('H', (0 for _ in range(n)))
+            for i in range(n):
+                  r, x = 0, i
+                  for _ in range(bits):
+                        r = (r << 1) | (x & 1)
+                        x >>= 1
+                  rev[i] = r
+            _tables[n] = (cos_t, sin_t, rev)
+      return _tables[n]
+
+#In place radix-2 FFT of the real and imaginary arrays
+def _fft(re: array, im: array):
+      n = len(re)
+      cos_t, sin_t, rev = _fft_tables(n)
+      for i in range(n):
+            j = rev[i]
+            if i < j:
+                  re[i], re[j] = re[j], re[i]
+                  im[i], im[j] = im[j], im[i]
+      size = 2
+      while size <= n:
+            half = size // 2
+            step = n // size
+            for start in range(0, n, size):
+                  k = 0
+                  for i in range(start, start + half):
+                        j = i + half
+                        c, s = cos_t[k], sin_t[k]
+                        tr = re[j]*c - im[j]*s
+                        ti = re[j]*s + im[j]*c
+                        re[j], im[j] = re[i] - tr, im[i] - ti
+                        re[i] += tr
+                        im[i] += ti
+                        k += step
+            size *= 2
+      return
+
+#Evenly sampled PPI at RESAMPLE_HZ by a natural cubic spline through the beats, like Kubios.
+#Linear interpolation damps the HF band, at 0.3 Hz and 70 bpm about a third of its power is lost.
+#One pass for the duration, one keeping the beats of the part that is used and the spline is solved over those
+def _resample(ppi: list) -> array:
+      duration, first = 0, True #ms from the first beat to the last
+      for rr in ppi:
+            if first:
+                  first = False
+            else:
+                  duration += rr
+      points = int(duration * RESAMPLE_HZ / 1000) + 1
+      skip = max(0, points - MAX_FFT)
+      step = 1000 / RESAMPLE_HZ
+      start = skip * step - SPLINE_MARGIN_MS
+
+      #Beat i happens at the sum of ppi[1..i], the beat before the margin is kept so the first point is inside
+      times, values = array('f'), array('f')
+      beat_time, before = 0, None
+      for rr in ppi:
+            if times or before is not None:
+                  beat_time += rr
+            if beat_time < start:
+                  before = (beat_time, rr)
+                  continue
+            if not times and before is not None and beat_time > start:
+                  times.append(before[0])
+                  values.append(before[1])
+            times.append(beat_time)
+            values.append(rr)
+      n = len(times)
+
+      #Second derivatives, tridiagonal system solved with the Thomas algorithm, 0 at both ends
+      m = array('f', (0 for _ in range(n)))
+      c = array('f', (0 for _ in range(n)))
+      for i in range(1, n - 1):
+            h0, h1 = times[i] - times[i-1], times[i+1] - times[i]
+            d = 6 * ((values[i+1] - values[i]) / h1 - (values[i] - values[i-1]) / h0)
+            b = 2 * (h0 + h1) - h0 * c[i-1]
+            c[i] = h1 / b
+            m[i] = (d - h0 * m[i-1]) / b
+      for i in range(n - 2, 0, -1):
+            m[i] -= c[i] * m[i+1]
+
+      out = array('f', (0 for _ in range(points - skip)))
+      i = 0
+      for k in range(skip, points):
+            t = k * step
+            while i < n - 2 and times[i+1] < t:
+                  i += 1
+            h = times[i+1] - times[i]
+            a, b = times[i+1] - t, t - times[i]
+            out[k - skip] = (m[i]*a*a*a + m[i+1]*b*b*b) / (6*h) + (values[i]/h - m[i]*h/6)*a + (values[i+1]/h - m[i+1]*h/6)*b
+      return out
+
+def frequency(ppi: list) -> dict:
+      if len(ppi) < 10:
+            raise ValueError('Frequency analysis needs atleast 10 PPI')
+      series = _resample(ppi)
+      points = len(series)
+      n = 16
+      while n < points:
+            n *= 2
+
+      #Remove the linear trend, then Hann window, zero padding up to n
+      mean_t = (points - 1) / 2
+      mean_v = sum(series) / points
+      cov, var = 0, 0
+      for i in range(points):
+            cov += (i - mean_t) * (series[i] - mean_v)
+            var += (i - mean_t)**2
+      slope = cov / var if var else 0
+      re = array('f', (0 for _ in range(n)))
+      im = array('f', (0 for _ in range(n)))
+      window_power = 0
+      for i in range(points):
+            w = 0.5 - 0.5*cos(2*pi*i / (points - 1))
+            re[i] = (series[i] - mean_v - slope*(i - mean_t)) * w
+            window_power += w*w
+      _fft(re, im)
+
+      #One sided power spectral density summed over the bands
+      df = RESAMPLE_HZ / n
+      scale = 2 / (RESAMPLE_HZ * window_power) * df
+      lf, hf, tp = 0, 0, 0
+      for k in range(1, n//2):
+            f = k * df
+            if f >= HF_BAND[1]:
+                  break
+            power = (re[k]*re[k] + im[k]*im[k]) * scale
+            tp += power
+            if LF_BAND[0] <= f < LF_BAND[1]:
+                  lf += power
+            elif f >= HF_BAND[0]:
+                  hf += power
+      data = {
+                  "lf": round(lf),
+                  "hf": round(hf),
+                  "lf_hf": min(round(lf / hf, 2), LF_HF_MAX) if hf else 0,
+                  "tp": round(tp)
+            }
+      return data
+
+#Extended time domain results from running sums, shared by time_domain and HrvAccumulator so both give the same keys.
+#Successive differences d: NN50 counts |d| > 50 ms, SD1^2 = var(d)/2 and SD2^2 = 2*SDNN^2 - SD1^2 (Poincare plot)
+def _time_results(count: int, mean: float, sdnn: float, sum_diff: int, sum_sq_diff: int, nn50: int, low: int, high: int) -> dict:
+      diffs = count - 1
+      var_diff = (sum_sq_diff - sum_diff*sum_diff/diffs) / (diffs-1) if diffs > 1 else 0
+      sd1 = sqrt(max(var_diff, 0) / 2)
+      sd2 = sqrt(max(2*sdnn*sdnn - sd1*sd1, 0))
+      data = {
+                  "mean_hr": round(60000 / mean),
+                  "mean_ppi": round(mean),
+                  "rmssd": round(sqrt(sum_sq_diff / diffs)),
+                  "sdnn": round(sdnn),
+                  "pnn50": round(100 * nn50 / diffs),
+                  "nn50": nn50,
+                  "sd1": round(sd1),
+                  "sd2": round(sd2),
+                  "min_hr": round(60000 / high),
+                  "max_hr": round(60000 / low)
+            }
+      return data
+
+#All the time domain parameters in one pass over the PPI that fall inside +-percent of the mean, like preprocess_ppi.
+#Only running sums, the filtered list is not built. PPI are ints so the sums are exact and SDNN can come from them
+def time_domain(ppi: list, percent: float = 0.2) -> dict:
+      average = mean_ppi(ppi)
+      low_bound = average*(1-percent)
+      up_bound = average*(1+percent)
+      count, total, total_sq = 0, 0, 0
+      sum_diff, sum_sq_diff, nn50 = 0, 0, 0
+      low, high = 0, 0
+      prev = 0
+      for rr in ppi:
+            if not low_bound < rr < up_bound:
+                  continue
+            if count:
+                  d = rr - prev
+                  sum_diff += d
+                  sum_sq_diff += d*d
+                  if d > 50 or d < -50:
+                        nn50 += 1
+                  if rr < low:
+                        low = rr
+                  elif rr > high:
+                        high = rr
+            else:
+                  low, high = rr, rr
+            prev = rr
+            count += 1
+            total += rr
+            total_sq += rr*rr
+      if count < 2:
+            raise ValueError('Array must be atleast 2 long to calculate diffrences')
+      mean = total / count
+      sdnn = sqrt(max(total_sq - total*total/count, 0) / (count-1))
+      return _time_results(count, mean, sdnn, sum_diff, sum_sq_diff, nn50, low, high)
+
 def full(ppi: list) -> dict:
-      ppi = preprocess_ppi(ppi)
       stamp = mktime(localtime())
-      mean_ppi_ = round(mean_ppi(ppi))
-      rmssd_ = round(rmssd(ppi))
-      sdnn_ = round(sdnn(ppi))
-      mean_hr_ = round(mean_hr(ppi))
       data = {
                   "id": stamp,
-                  "timestamp": stamp,
-                  "mean_hr": mean_hr_,
-                  "mean_ppi": mean_ppi_,
-                  "rmssd": rmssd_,
-                  "sdnn": sdnn_
+                  "timestamp": stamp
             }
+      data.update(time_domain(ppi))
+      try:
+            data.update(frequency(Within(ppi)))
+      except ValueError: #Too few beats left for the frequency domain, the time domain results are still valid
+            pass
       return data
+
+
+#Local estimate of the Kubios readiness analysis for when Kubios can not be reached, same fields as utility.parse_kubios_message.
+#Like Kubios, PNS is the mean z-score of mean PPI, RMSSD and SD1 and SNS of mean HR, Baevsky stress index and SD2 (negated),
+#against approximate resting adult norms (mean, sd). Physiological age is left out, readiness is 50 % plus 12.5 % per index difference
+NORMS = {
+            "mean_ppi": (926, 90),
+            "rmssd": (42, 15),
+            "sd1": (30, 11),
+            "mean_hr": (66, 8),
+            "stress": (10, 3), #Square root of the stress index like Kubios
+            "sd2": (60, 20)
+      }
+
+def _z(name: str, value: float) -> float:
+      mean, sd = NORMS[name]
+      return (value - mean) / sd
+
+#Baevsky stress index from a 50 ms histogram, amplitude of the mode in % / (2 * mode * range), times in seconds
+def stress_index(ppi: list) -> float:
+      bins = {}
+      count, low, high = 0, 0, 0
+      for rr in ppi:
+            bins[rr // 50] = bins.get(rr // 50, 0) + 1
+            low, high = (min(low, rr), max(high, rr)) if count else (rr, rr)
+            count += 1
+      mode = max(bins, key=bins.get)
+      amo = 100 * bins[mode] / count
+      mo = (mode * 50 + 25) / 1000
+      mxdmn = max(high - low, 1) / 1000
+      return amo / (2 * mo * mxdmn)
+
+def estimate_readiness(ppi: list) -> dict:
+      data = time_domain(ppi)
+      stress = sqrt(stress_index(Within(ppi)))
+      pns = (_z("mean_ppi", data["mean_ppi"]) + _z("rmssd", data["rmssd"]) + _z("sd1", data["sd1"])) / 3
+      sns = (_z("mean_hr", data["mean_hr"]) + _z("stress", stress) - _z("sd2", data["sd2"])) / 3
+      stamp = mktime(localtime())
+      result = {
+                  "id": stamp,
+                  "timestamp": stamp,
+                  "mean_hr": data["mean_hr"],
+                  "mean_ppi": data["mean_ppi"],
+                  "rmssd": data["rmssd"],
+                  "sdnn": data["sdnn"],
+                  "sns": f'{sns:.2f}',
+                  "pns": f'{pns:.2f}',
+                  "readiness": round(min(max(50 + 12.5 * (pns - sns), 0), 100)),
+                  "source": "local"
+            }
+      return result
+
+
+#Streaming version of full, fed one PPI at a time while measuring so the results are ready when the measurement ends.
+#Welford mean and variance for SDNN and running sums of the successive differences for the rest.
+#Outliers are rejected against the running mean like preprocess_ppi does against the final mean. The mean starts
+#from the median of the first warmup beats so missed beats at the start do not anchor it, and if warmup beats
+#in a row are rejected the rhythm has really changed and the results start over like LiveHr does, the beats before it are dropped.
+#A beat near the limit can so be taken here and left out by full of the same series, or the other way round.
+#The accepted beats are kept in beats, frequency of them gives the frequency domain of the same beats
+class HrvAccumulator:
+      def __init__(self, percent: float = 0.2, warmup: int = 5):
+            self.percent = percent
+            self.warmup = warmup #Beats the starting median is taken from
+            self.rejected, self.rejected_in_row = 0, 0
+            self._restart()
+
+      def _restart(self):
+            self.seed = [] #First beats, held until there are warmup of them
+            self.beats = array('H')
+            self.count = 0
+            self.mean, self.m2 = 0.0, 0.0
+            self.sum_diff, self.sum_sq_diff, self.nn50 = 0, 0, 0
+            self.low, self.high = 0, 0
+            self.prev = 0
+            self.rejected_in_row = 0
+            return
+
+      #O(1) per beat after the warmup, returns False if the beat was rejected. Beats held for the median count as accepted
+      def push(self, ppi: int) -> bool:
+            if self.seed is None:
+                  return self._check(ppi, self.mean)
+            self.seed.append(ppi)
+            if len(self.seed) < self.warmup:
+                  return True
+            seed, self.seed = self.seed, None
+            median = sorted(seed)[len(seed) // 2]
+            accepted = False
+            for rr in seed:
+                  accepted = self._check(rr, median)
+            return accepted
+
+      def _check(self, ppi: int, mean: float) -> bool:
+            if not (mean*(1-self.percent) < ppi < mean*(1+self.percent)):
+                  self.rejected += 1
+                  self.rejected_in_row += 1
+                  if self.rejected_in_row >= self.warmup:
+                        self._restart()
+                  return False
+            self.rejected_in_row = 0
+            self._add(ppi)
+            return True
+
+      def _add(self, ppi: int):
+            if self.count:
+                  d = ppi - self.prev
+                  self.sum_diff += d
+                  self.sum_sq_diff += d*d
+                  if d > 50 or d < -50:
+                        self.nn50 += 1
+                  self.low = min(self.low, ppi)
+                  self.high = max(self.high, ppi)
+            else:
+                  self.low, self.high = ppi, ppi
+            self.prev = ppi
+            self.beats.append(ppi)
+            self.count += 1
+            delta = ppi - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (ppi - self.mean)
+            return
+
+      def mean_ppi(self) -> float:
+            if not self.count:
+                  raise ValueError('Can not calculate mean values from empty list')
+            return self.mean
+
+      def mean_hr(self) -> float:
+            return 60000 / self.mean_ppi()
+
+      def rmssd(self) -> float:
+            if self.count < 2:
+                  raise ValueError('Array must be atleast 2 long to calculate diffrences')
+            return sqrt(self.sum_sq_diff / (self.count-1))
+
+      def sdnn(self) -> float:
+            if self.count < 2:
+                  raise ValueError('Array must be atleast 2 long to calculate diffrences')
+            return sqrt(self.m2 / (self.count-1))
+
+      #Same dict as full without the frequency domain
+      def results(self) -> dict:
+            stamp = mktime(localtime())
+            data = {
+                        "id": stamp,
+                        "timestamp": stamp
+                  }
+            data.update(_time_results(self.count, self.mean_ppi(), self.sdnn(), self.sum_diff,
+                                      self.sum_sq_diff, self.nn50, self.low, self.high))
+            return data
+
+
+#Live heart rate from the last size accepted beats, O(1) per beat with a running sum.
+#A beat outside +-percent of the window mean is rejected and leaves the BPM as it was,
+#if rejected beats keep coming the rhythm has really changed and the window starts over
+class LiveHr:
+      def __init__(self, size: int = 10, percent: float = 0.3, min_beats: int = 5):
+            self.size = size
+            self.percent = percent
+            self.min_beats = min_beats
+            self.beats = array('H', (0 for _ in range(size)))
+            self.head, self.count, self.total = 0, 0, 0
+            self.rejected_in_row = 0
+
+      #Returns False if the beat was rejected
+      def push(self, ppi: int) -> bool:
+            if self.count >= self.min_beats:
+                  mean = self.total / self.count
+                  if not (mean*(1-self.percent) < ppi < mean*(1+self.percent)):
+                        self.rejected_in_row += 1
+                        if self.rejected_in_row < self.min_beats:
+                              return False
+                        self.head, self.count, self.total = 0, 0, 0
+            self.rejected_in_row = 0
+            if self.count == self.size:
+                  self.total -= self.beats[self.head]
+            else:
+                  self.count += 1
+            self.beats[self.head] = ppi
+            self.total += ppi
+            self.head = (self.head + 1) % self.size
+            return True
+
+      #0 until there are enough beats
+      def bpm(self) -> int:
+            if self.count < self.min_beats:
+                  return 0
+            return round(60000 * self.count / self.total)
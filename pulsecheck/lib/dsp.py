@@ -0,0 +1,169 @@
+from array import array
+
+'''This file contains the signal processing building blocks used by the measuring states.
+All the buffers are allocated once on creation, pushing a sample does not allocate'''
+
+#Fixed size circular buffer for the 16-bit ADC samples
+class RingBuffer:
+      def __init__(self, size: int, typecode: str = 'H'):
+            self.size = size
+            self.data = array(typecode, (0 for _ in range(size)))
+            self.head = 0 #Index where the next sample is written
+            self.count = 0
+
+      #Overwrites the oldest sample when full, O(1) op
+      def push(self, value: int):
+            self.data[self.head] = value
+            self.head += 1
+            if self.head == self.size:
+                  self.head = 0
+            if self.count < self.size:
+                  self.count += 1
+            return
+
+      def __len__(self) -> int:
+            return self.count
+
+      #Index 0 is the oldest sample, -1 the newest like with a list
+      def __getitem__(self, i: int) -> int:
+            if i < 0:
+                  i += self.count
+            if not 0 <= i < self.count:
+                  raise IndexError('RingBuffer index out of range')
+            return self.data[(self.head - self.count + i) % self.size]
+
+
+#Min and max of the last size samples in O(1) amortised per push, using two monotonic deques
+class WindowMinMax:
+      def __init__(self, size: int, typecode: str = 'H'):
+            self.size = size
+            self.n = 0 #Running sample index
+            #Deques are circular arrays of (sample index, value), max deque decreasing and min deque increasing
+            self.max_idx = array('L', (0 for _ in range(size)))
+            self.max_val = array(typecode, (0 for _ in range(size)))
+            self.min_idx = array('L', (0 for _ in range(size)))
+            self.min_val = array(typecode, (0 for _ in range(size)))
+            self.max_head, self.max_len = 0, 0
+            self.min_head, self.min_len = 0, 0
+            self.max, self.min = 0, 0
+
+      def push(self, value: int):
+            size = self.size
+            n = self.n
+            self.n = n + 1
+
+            #Max deque: drop the expired index from the front, then smaller values from the back
+            head, length = self.max_head, self.max_len
+            if length and n - self.max_idx[head] >= size:
+                  head = (head + 1) % size
+                  length -= 1
+            while length and self.max_val[(head + length - 1) % size] <= value:
+                  length -= 1
+            tail = (head + length) % size
+            self.max_idx[tail] = n
+            self.max_val[tail] = value
+            length += 1
+            self.max_head, self.max_len = head, length
+            self.max = self.max_val[head]
+
+            #Min deque: same with larger values
+            head, length = self.min_head, self.min_len
+            if length and n - self.min_idx[head] >= size:
+                  head = (head + 1) % size
+                  length -= 1
+            while length and self.min_val[(head + length - 1) % size] >= value:
+                  length -= 1
+            tail = (head + length) % size
+            self.min_idx[tail] = n
+            self.min_val[tail] = value
+            length += 1
+            self.min_head, self.min_len = head, length
+            self.min = self.min_val[head]
+            return
+
+
+#Fixed point front end of the peak detector: band-pass, derivative and the integrated squared rising slope.
+#Everything stays a small int (under 2**30) so pushing a sample does not allocate on the Pico
+class PulseFilter:
+      def __init__(self, hz: int = 250, window: int = 32):
+            #High-pass pole for the ~0.5 Hz baseline wander in Q12, 1 - 2*pi*fc/fs
+            self.hp_coef = 4096 - 4096 * 314 // (100 * hz)
+            self.x_prev, self.hp = 0, 0
+            #Two low-pass stages, ~5 Hz each at 250 Hz, states kept 8 times bigger for precision
+            self.lp_acc, self.lp_acc2 = 0, 0
+            #Last 4 outputs for the slope
+            self.y1, self.y2, self.y3, self.y4 = 0, 0, 0, 0
+            #Moving window integrator of the squared slope, window must be a power of two
+            self.shift = 0
+            while (1 << self.shift) < window:
+                  self.shift += 1
+            self.window = array('l', (0 for _ in range(window)))
+            self.head, self.total = 0, 0
+            self.filtered = 0 #Band-passed signal, for plotting
+            self.envelope = 0 #Detection signal, peaks on the rising edge of the pulse
+
+      def push(self, raw: int):
+            x = raw >> 2 #14-bit, keeps the squares small
+            hp = x - self.x_prev + (self.hp_coef * self.hp >> 12)
+            self.x_prev, self.hp = x, hp
+            lp = self.lp_acc
+            lp += hp - (lp >> 3)
+            lp2 = self.lp_acc2
+            lp2 += (lp >> 3) - (lp2 >> 3)
+            self.lp_acc, self.lp_acc2 = lp, lp2
+            y = lp2 >> 3
+
+            #Slope over 4 samples, only rising edges, clamped so the square fits
+            d = y - self.y4
+            self.y4, self.y3, self.y2, self.y1 = self.y3, self.y2, self.y1, y
+            if d < 0:
+                  d = 0
+            elif d > 4095:
+                  d = 4095
+
+            square = d * d
+            head = self.head
+            self.total += square - self.window[head]
+            self.window[head] = square
+            head += 1
+            self.head = 0 if head == len(self.window) else head
+
+            self.filtered = y
+            self.envelope = self.total >> self.shift
+            return
+
+
+#Threshold crossing detector on the envelope, the threshold is 60% of the envelope range over the last size samples
+class PeakDetector:
+      minmax = WindowMinMax
+
+      def __init__(self, size: int = 500):
+            self.size = size
+            self.window = self.minmax(size, 'l')
+            self.threshold = 0
+            self.edge = False
+            self.envelope, self.prev_envelope = 0, 0
+
+      #Returns 1 when the envelope rises over the threshold, -1 when it falls back under and 0 otherwise.
+      #Nothing is detected until the window is full
+      def push(self, envelope: int) -> int:
+            window = self.window
+            window.push(envelope)
+            self.prev_envelope, self.envelope = self.envelope, envelope
+            if window.n < self.size:
+                  return 0
+            threshold = window.min + (window.max - window.min) * 3 // 5
+            self.threshold = threshold
+            if envelope > threshold and not self.edge:
+                  self.edge = True
+                  return 1
+            elif envelope < threshold and self.edge:
+                  self.edge = False
+                  return -1
+            return 0
+
+      #Fraction of a sample since the envelope crossed the threshold, by linear interpolation
+      def fraction(self) -> float:
+            if self.prev_envelope >= self.threshold or self.envelope == self.prev_envelope:
+                  return 0
+            return (self.envelope - self.threshold) / (self.envelope - self.prev_envelope)
@@ -0,0 +1,93 @@
+import micropython # type: ignore
+from lib import dsp # type: ignore
+
+'''Native emitter build of the per sample classes in dsp.py, measure.py imports this when the port supports it.
+The methods are copies of the ones in dsp.py, which stay as the reference and the fallback.
+Change both together, tools/check.py checks that they give the same peaks'''
+
+class WindowMinMax(dsp.WindowMinMax):
+      @micropython.native
+      def push(self, value: int):
+            size = self.size
+            n = self.n
+            self.n = n + 1
+
+            head, length = self.max_head, self.max_len
+            if length and n - self.max_idx[head] >= size:
+                  head = (head + 1) % size
+                  length -= 1
+            while length and self.max_val[(head + length - 1) % size] <= value:
+                  length -= 1
+            tail = (head + length) % size
+            self.max_idx[tail] = n
+            self.max_val[tail] = value
+            length += 1
+            self.max_head, self.max_len = head, length
+            self.max = self.max_val[head]
+
+            head, length = self.min_head, self.min_len
+            if length and n - self.min_idx[head] >= size:
+                  head = (head + 1) % size
+                  length -= 1
+            while length and self.min_val[(head + length - 1) % size] >= value:
+                  length -= 1
+            tail = (head + length) % size
+            self.min_idx[tail] = n
+            self.min_val[tail] = value
+            length += 1
+            self.min_head, self.min_len = head, length
+            self.min = self.min_val[head]
+            return
+
+
+class PulseFilter(dsp.PulseFilter):
+      @micropython.native
+      def push(self, raw: int):
+            x = raw >> 2
+            hp = x - self.x_prev + (self.hp_coef * self.hp >> 12)
+            self.x_prev, self.hp = x, hp
+            lp = self.lp_acc
+            lp += hp - (lp >> 3)
+            lp2 = self.lp_acc2
+            lp2 += (lp >> 3) - (lp2 >> 3)
+            self.lp_acc, self.lp_acc2 = lp, lp2
+            y = lp2 >> 3
+
+            d = y - self.y4
+            self.y4, self.y3, self.y2, self.y1 = self.y3, self.y2, self.y1, y
+            if d < 0:
+                  d = 0
+            elif d > 4095:
+                  d = 4095
+
+            square = d * d
+            head = self.head
+            self.total += square - self.window[head]
+            self.window[head] = square
+            head += 1
+            self.head = 0 if head == len(self.window) else head
+
+            self.filtered = y
+            self.envelope = self.total >> self.shift
+            return
+
+
+class PeakDetector(dsp.PeakDetector):
+      minmax = WindowMinMax
+
+      @micropython.native
+      def push(self, envelope: int) -> int:
+            window = self.window
+            window.push(envelope)
+            self.prev_envelope, self.envelope = self.envelope, envelope
+            if window.n < self.size:
+                  return 0
+            threshold = window.min + (window.max - window.min) * 3 // 5
+            self.threshold = threshold
+            if envelope > threshold and not self.edge:
+                  self.edge = True
+                  return 1
+            elif envelope < threshold and self.edge:
+                  self.edge = False
+                  return -1
+            return 0
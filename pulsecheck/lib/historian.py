@@ -1,67 +1,457 @@
-import os, ujson
-from time import localtime, mktime
+import os, struct
+from array import array
+from ppi_log import PpiLog
+from time import localtime, mktime, ticks_ms, ticks_diff
 
-'''This class controls the /history folder and its measurement history contents, 
-You can save and read from diffrent files in the folder
-The class keeps the folder to a max size. 
-All the measurements saved in separate txt files as json objects
-The class is a singleton'''
+'''This class controls the /hist folder and its measurement history contents.
+All the measurements are saved in one binary log of fixed size records, a new measurement
+is one write at its record offset and reading one only reads that record.
+The log is circular, when it is full the oldest record is overwritten.
+Capacity comes from the flash budget given in kB, the log is rewritten if the budget changes.
+The class is a singleton
+
+Log layout, little endian:
+    header  magic 'PCHL', version, reserved, capacity, record size
+    records seq number, timestamp, type, presence mask, one int32 per field in FIELDS
+Slot of a record is (seq - 1) % capacity, an empty log has no records after the header
+
+Index, same slots without a header:
+    entries seq number, timestamp, type, mean HR, RMSSD, SDNN
+The index is what the history menu reads, it is rebuilt from the log if it does not match
+
+Rollups, DAYS daily then WEEKS weekly slots, the slot of a period is its number % slots:
+    slots   first day of the period, measurements, sums of mean HR, RMSSD and SDNN
+They are kept in RAM and the two slots a measurement changes are written with it,
+so trends cost the same however long the history is. A record the log overwrites is taken out
+of its slots, so they only count what is still in the log. Rebuilt from the index if missing
+
+The PPI series of the measurements are kept in lib/ppi_log.py
+
+Writes are queued in RAM and saved by flush, which the idle states call so results show without waiting
+for flash. The queue is in the singleton so it survives state changes, reads flush it first.
+Queued measurements are lost on a reset, queued() and the flush times are shown in the status view'''
 
 class History:
       _instance = None
+      _initted = False
       _dir = 'hist'
+      _log = 'hist/log.bin'
+      _index = 'hist/index.bin'
+      _rollup = 'hist/rollup.bin'
+
+      BUDGET_KB = 128 #Default flash budget, about 1500 measurements
+      PPI_KB = 64 #Default flash for the PPI series, about 1000 30 s measurements
+      HEADER = '<4sBBHH'
+      MAGIC = b'PCHL'
+      VERSION = 1
+      TYPES = ('hrv', 'kubios', 'local')
+      #Every result field of analysis and utility.parse_kubios_message, in the order they are shown
+      FIELDS = ('mean_hr', 'mean_ppi', 'rmssd', 'sdnn', 'pnn50', 'nn50', 'sd1', 'sd2', 'min_hr', 'max_hr',
+                'lf', 'hf', 'lf_hf', 'tp', 'sns', 'pns', 'phys_age', 'readiness')
+      SCALED = ('lf_hf', 'sns', 'pns') #Stored as hundredths
+      INT_MIN, INT_MAX = -0x80000000, 0x7FFFFFFF #Range of a field
+      TEXT = ('sns', 'pns') #Kubios indexes are formatted strings
+      RECORD = '<IIII' + 'i' * len(FIELDS)
+      INDEX = '<IIBBHH'
+      ROLLUP = '<iHIII'
+      DAYS = 64 #Daily rollups kept
+      WEEKS = 52
+      TREND_FIELDS = ('mean_hr', 'rmssd', 'sdnn')
 
       #When creating an instance this is ran before __init__
-      def __new__(cls):
+      def __new__(cls, *args):
             #If an instance of the class doesn't exist, create one. else return the current.
             if cls._instance is None:
                   cls._instance = super().__new__(cls)
             return cls._instance
-      
-      def __init__(self):
+
+      def __init__(self, budget_kb: int = BUDGET_KB, ppi_kb: int = PPI_KB):
+            if self._initted:
+                  return
+            self._initted = True
+            self.header_size = struct.calcsize(self.HEADER)
+            self.record_size = struct.calcsize(self.RECORD)
+            self.index_size = struct.calcsize(self.INDEX)
+            self.rollup_size = struct.calcsize(self.ROLLUP)
+            slots = self.DAYS + self.WEEKS
+            self.periods = array('l', (-1 for _ in range(slots)))
+            self.counts = array('H', (0 for _ in range(slots)))
+            self.sums = array('L', (0 for _ in range(3 * slots)))
+            self.wanted = min(max(1, (budget_kb * 1024 - self.header_size) // self.record_size), 0xFFFF)
             if self._dir not in os.listdir():
                   os.mkdir(self._dir)
+            self.series = PpiLog(ppi_kb)
+            self.pending = [] #(data, ppi) not yet on flash
+            self.flush_ms, self.worst_flush_ms = 0, 0
+            self._open()
+            self._check_index()
+            self._load_rollups()
+            self._migrate()
             return
 
-      #Create and save a new measurement.txt file
-      def write(self, data: dict):
-            self._folder_manager()
-            date = mktime(localtime())
-            #File name is formatted: name_secondsfrom1stjan2000
-            file = f'meas_{date}'
+      #Read the header of the log or create a new log, then find the newest record
+      def _open(self):
+            magic = None
             try:
-                  with open(f'./{self._dir}/{file}', 'x') as f:
-                        ujson.dump(data, f)
-            except OSError or FileExistsError:
-                  print('File already exists')
+                  with open(self._log, 'rb') as f:
+                        header = f.read(self.header_size)
+                  if len(header) == self.header_size:
+                        magic, version, _, capacity, size = struct.unpack(self.HEADER, header)
+                  length = os.stat(self._log)[6]
+            except OSError:
+                  pass
+            if magic != self.MAGIC or version != self.VERSION or size != self.record_size:
+                  if magic is not None:
+                        print('History log not compatible, starting a new one')
+                  self._create()
+                  return
+            self.capacity = capacity
+            self.count = min((length - self.header_size) // self.record_size, capacity)
+            self.last_seq = self._seq_at(self._find_newest()) if self.count else 0
+            if capacity != self.wanted:
+                  self._resize()
+            return
+
+      def _create(self, path: str = _log):
+            self.capacity = self.wanted
+            with open(path, 'wb') as f:
+                  f.write(struct.pack(self.HEADER, self.MAGIC, self.VERSION, 0, self.capacity, self.record_size))
+            self.count, self.last_seq = 0, 0
+            if path == self._log:
+                  open(self._index, 'wb').close()
+                  open(self._rollup, 'wb').close() #Rebuilt empty on load
+                  self.series.clear()
             return
 
-      #Read data from a chosen measurement.txt file
-      def read(self, file: str) -> dict:
+      #The index must have an entry for every record and the newest entry must be the newest record
+      def _check_index(self):
             try:
-                  with open(f'./{self._dir}/{file}', 'r') as f:
-                        data = ujson.load(f)
+                  length = os.stat(self._index)[6]
+                  if length == self.count * self.index_size and (not self.count or self._entries(0, 1)[0][0] == self.last_seq):
+                        return
             except OSError:
-                  print('File not found')
-            except ValueError:
-                  print('Can not read data')
-            return data
-
-      #Read contents of the /history folder
-      def contents(self) -> list:
-            return os.listdir(f'./{self._dir}')
-
-      #Keep the size of the /history folder within limits
-      def _folder_manager(self):
-            files = os.listdir(f'./{self._dir}')
-            if len(files) > 6:
-                  files.sort()
-                  os.remove(f'./{self._dir}/{files[0]}')
+                  pass
+            self._rebuild_index()
             return
-      
-      #Empty the folder
-      def empty(self):
-            files = os.listdir(f'./{self._dir}')
+
+      #Index entries in slot order from the log, one record at a time
+      def _rebuild_index(self):
+            with open(self._log, 'rb') as src, open(self._index, 'wb') as dst:
+                  src.seek(self.header_size)
+                  for _ in range(self.count):
+                        seq, kind, data = self._unpack(src.read(self.record_size))
+                        dst.write(self._pack_entry(seq, data["timestamp"], kind, data))
+            print(f'History index rebuilt, {self.count} measurements')
+            return
+
+      def _pack_entry(self, seq: int, stamp: int, kind: int, data: dict) -> bytes:
+            mean_hr = min(int(data.get('mean_hr', 0)), 0xFF)
+            rmssd = min(int(data.get('rmssd', 0)), 0xFFFF)
+            sdnn = min(int(data.get('sdnn', 0)), 0xFFFF)
+            return struct.pack(self.INDEX, seq, stamp, kind, mean_hr, rmssd, sdnn)
+
+      #Copy the newest records that fit to a log of the wanted capacity one record at a time, seq numbers start over
+      def _resize(self):
+            keep = min(self.count, self.wanted)
+            first = self.last_seq - keep + 1
+            old_capacity = self.capacity
+            new = self._log + '.new'
+            self._create(new)
+            with open(self._log, 'rb') as src, open(new, 'r+b') as dst:
+                  dst.seek(self.header_size)
+                  for i in range(keep):
+                        src.seek(self.header_size + (first + i - 1) % old_capacity * self.record_size)
+                        record = bytearray(src.read(self.record_size))
+                        struct.pack_into('<I', record, 0, i + 1)
+                        dst.write(record)
+            os.remove(self._log)
+            os.rename(new, self._log)
+            self.series.renumber(((first + i - 1) % old_capacity, first + i, i + 1) for i in range(keep))
+            self.count, self.last_seq = keep, keep
+            self._rebuild_index()
+            open(self._rollup, 'wb').close() #Dropped records are in the rollups, rebuilt on load
+            print(f'History log resized from {old_capacity} to {self.capacity} measurements')
+            return
+
+      #Slots fill in seq order, after wrapping the newest is the last slot with a seq not smaller than slot 0.
+      #Binary search, so opening reads log2(capacity) records
+      def _find_newest(self) -> int:
+            if self.count < self.capacity:
+                  return self.count - 1
+            first = self._seq_at(0)
+            low, high = 0, self.capacity - 1
+            while low < high:
+                  mid = (low + high + 1) // 2
+                  if self._seq_at(mid) >= first:
+                        low = mid
+                  else:
+                        high = mid - 1
+            return low
+
+      def _seq_at(self, slot: int) -> int:
+            with open(self._log, 'rb') as f:
+                  f.seek(self.header_size + slot * self.record_size)
+                  return struct.unpack('<I', f.read(4))[0]
+
+      def _kind(self, data: dict) -> int:
+            if 'source' in data:
+                  return 2
+            elif 'sns' in data:
+                  return 1
+            return 0
+
+      def _pack(self, seq: int, data: dict) -> bytes:
+            kind = self._kind(data)
+            mask, values = 0, []
+            for i, name in enumerate(self.FIELDS):
+                  value = data.get(name)
+                  if value is None:
+                        values.append(0)
+                        continue
+                  mask |= 1 << i
+                  if name in self.SCALED:
+                        value = float(value) * 100
+                  values.append(min(max(round(value), self.INT_MIN), self.INT_MAX)) #A value out of the field would stop the flush
+            stamp = int(data.get('timestamp', mktime(localtime())))
+            return struct.pack(self.RECORD, seq, stamp, kind, mask, *values)
+
+      def _unpack(self, record: bytes) -> tuple:
+            fields = struct.unpack(self.RECORD, record)
+            seq, stamp, kind, mask = fields[:4]
+            data = {"id": stamp, "timestamp": stamp}
+            for i, name in enumerate(self.FIELDS):
+                  if not mask & (1 << i):
+                        continue
+                  value = fields[4 + i]
+                  if name in self.TEXT:
+                        value = f'{value / 100:.2f}'
+                  elif name in self.SCALED:
+                        value = value / 100
+                  data[name] = value
+            if kind == 2:
+                  data["source"] = "local"
+            return seq, kind, data
+
+      #Read the record with the given seq number from an open log, None if it has been overwritten
+      def _read_seq(self, f, seq: int) -> tuple | None:
+            if not (self.last_seq - self.count < seq <= self.last_seq):
+                  return None
+            f.seek(self.header_size + (seq - 1) % self.capacity * self.record_size)
+            record = self._unpack(f.read(self.record_size))
+            return record if record[0] == seq else None
+
+      #Amount of measurements saved
+      def __len__(self) -> int:
+            self.flush()
+            return self.count
+
+      #Measurements waiting for flush
+      def queued(self) -> int:
+            return len(self.pending)
+
+      #Queue a measurement to be saved by flush, the PPI series it was calculated from is saved with it if given
+      def write(self, data: dict, ppi: list | None = None):
+            self.pending.append((data, ppi))
+            return
+
+      #Save the queued measurements, the time it took is kept in flush_ms and the worst in worst_flush_ms
+      def flush(self):
+            if not self.pending:
+                  return
+            start = ticks_ms()
+            while self.pending:
+                  data, ppi = self.pending.pop(0)
+                  self._write(data, ppi)
+            self.flush_ms = ticks_diff(ticks_ms(), start)
+            self.worst_flush_ms = max(self.worst_flush_ms, self.flush_ms)
+            return
+
+      #Append a measurement to the log in one write, its index entry in another and update the rollups.
+      #When the log is full the entry of the overwritten record is read first and taken out of its rollups
+      def _write(self, data: dict, ppi: list | None = None):
+            seq = self.last_seq + 1
+            record = self._pack(seq, data)
+            entry = self._pack_entry(seq, struct.unpack_from('<I', record, 4)[0], self._kind(data), data)
+            slot = (seq - 1) % self.capacity
+            try:
+                  with open(self._log, 'r+b') as f:
+                        f.seek(self.header_size + slot * self.record_size)
+                        f.write(record)
+                  with open(self._index, 'r+b') as f:
+                        f.seek(slot * self.index_size)
+                        old = f.read(self.index_size) if self.count == self.capacity else b''
+                        f.seek(slot * self.index_size)
+                        f.write(entry)
+                  changed = self._add_rollup(struct.unpack(self.INDEX, entry))
+                  if len(old) == self.index_size:
+                        changed += self._add_rollup(struct.unpack(self.INDEX, old), -1)
+                  self._save_rollups(changed)
+                  if ppi:
+                        self.series.write(seq, slot, ppi)
+            except OSError:
+                  print('History not saved')
+                  return
+            self.last_seq = seq
+            self.count = min(self.count + 1, self.capacity)
+            return
+
+      #Replace the measurement made at stamp with data, like the Kubios result of a request that was queued.
+      #It keeps its place in the log and its PPI series and the rollups are corrected. False if it is no longer in the history
+      def update(self, stamp: int, data: dict) -> bool:
+            self.flush()
+            with open(self._index, 'rb') as f:
+                  for i in range(self.count): #Newest first, a result comes soon after its measurement
+                        slot = (self.last_seq - i - 1) % self.capacity
+                        f.seek(slot * self.index_size)
+                        old = struct.unpack(self.INDEX, f.read(self.index_size))
+                        if old[1] == stamp:
+                              break
+                  else:
+                        return False
+            data = dict(data)
+            data["timestamp"] = stamp
+            record = self._pack(old[0], data)
+            entry = self._pack_entry(old[0], stamp, self._kind(data), data)
+            try:
+                  with open(self._log, 'r+b') as f:
+                        f.seek(self.header_size + slot * self.record_size)
+                        f.write(record)
+                  with open(self._index, 'r+b') as f:
+                        f.seek(slot * self.index_size)
+                        f.write(entry)
+                  self._save_rollups(self._add_rollup(old, -1) + self._add_rollup(struct.unpack(self.INDEX, entry)))
+            except OSError:
+                  print('History not saved')
+                  return False
+            return True
+
+      #Read a measurement with a name from names
+      def read(self, name: str) -> dict:
+            self.flush()
+            with open(self._log, 'rb') as f:
+                  record = self._read_seq(f, int(name.split('_')[-1]))
+            if record is None:
+                  print('Record not found')
+                  return {}
+            return record[2]
+
+      #PPI series of a measurement with a name from names, None if it was not stored.
+      #Iterating it reads it from flash, analysis.full, time_domain and estimate_readiness take it instead of a list.
+      #preprocess_ppi would decode it into one, analysis.Within filters it without
+      def ppi(self, name: str) -> object | None:
+            self.flush()
+            seq = int(name.split('_')[-1])
+            if not (self.last_seq - self.count < seq <= self.last_seq):
+                  return None
+            return self.series.read(seq, (seq - 1) % self.capacity)
+
+      #Index entries (seq, timestamp, type, mean HR, RMSSD, SDNN) of count measurements from start, 0 is the newest
+      def _entries(self, start: int, count: int) -> list:
+            self.flush()
+            entries = []
+            with open(self._index, 'rb') as f:
+                  for i in range(start, min(start + count, self.count)):
+                        f.seek((self.last_seq - i - 1) % self.capacity * self.index_size)
+                        entries.append(struct.unpack(self.INDEX, f.read(self.index_size)))
+            return entries
+
+      #Names of count measurements from start, 0 is the newest. Formatted type_timestamp_seq.
+      #Only the index entries of these are read so a page of the history costs the same however long it is
+      def names(self, start: int, count: int) -> list:
+            return [f'{self.TYPES[entry[2]]}_{entry[1]}_{entry[0]}' for entry in self._entries(start, count)]
+
+      #Add an index entry to its daily and weekly rollups, or take it out with sign -1, returns the changed slots.
+      #Entries older than what a slot already holds are left out, so they are not taken out either
+      def _add_rollup(self, entry: tuple, sign: int = 1) -> tuple:
+            stamp = entry[1]
+            day = stamp // 86400
+            monday = day - localtime(stamp)[6]
+            changed = (day % self.DAYS, self.DAYS + monday // 7 % self.WEEKS)
+            for slot, period in zip(changed, (day, monday)):
+                  if period < self.periods[slot] or (sign < 0 and (period > self.periods[slot] or not self.counts[slot])):
+                        continue
+                  if period > self.periods[slot]:
+                        self.periods[slot], self.counts[slot] = period, 0
+                        for i in range(3):
+                              self.sums[3*slot + i] = 0
+                  self.counts[slot] += sign
+                  for i in range(3):
+                        self.sums[3*slot + i] = max(0, self.sums[3*slot + i] + sign * entry[3 + i])
+            return changed
+
+      #Write rollup slots, all of them if slots is None
+      def _save_rollups(self, slots: tuple | None = None):
+            with open(self._rollup, 'r+b' if slots else 'wb') as f:
+                  for slot in slots or range(len(self.periods)):
+                        f.seek(slot * self.rollup_size)
+                        f.write(struct.pack(self.ROLLUP, self.periods[slot], self.counts[slot],
+                                            self.sums[3*slot], self.sums[3*slot + 1], self.sums[3*slot + 2]))
+            return
+
+      def _load_rollups(self):
+            try:
+                  with open(self._rollup, 'rb') as f:
+                        if os.stat(self._rollup)[6] == len(self.periods) * self.rollup_size:
+                              for slot in range(len(self.periods)):
+                                    fields = struct.unpack(self.ROLLUP, f.read(self.rollup_size))
+                                    self.periods[slot], self.counts[slot] = fields[0], fields[1]
+                                    for i in range(3):
+                                          self.sums[3*slot + i] = fields[2 + i]
+                              return
+            except OSError:
+                  pass
+            #Missing or old, rebuild from the index in slot order one entry at a time
+            for slot in range(len(self.periods)):
+                  self.periods[slot], self.counts[slot] = -1, 0
+            for i in range(len(self.sums)):
+                  self.sums[i] = 0
+            with open(self._index, 'rb') as f:
+                  for _ in range(self.count):
+                        self._add_rollup(struct.unpack(self.INDEX, f.read(self.index_size)))
+            self._save_rollups()
+            return
+
+      #Mean of a field in TREND_FIELDS for the last periods days or weeks, oldest first and 0 for periods without measurements.
+      #The last period is the newest with measurements
+      def trend(self, field: str, weekly: bool, periods: int) -> list:
+            self.flush()
+            first, slots, step = (self.DAYS, self.WEEKS, 7) if weekly else (0, self.DAYS, 1)
+            newest = max(self.periods[first:first + slots])
+            i = self.TREND_FIELDS.index(field)
+            means = []
+            for k in range(periods - 1, -1, -1):
+                  period = newest - k * step
+                  slot = first + period // step % slots
+                  if newest < 0 or self.periods[slot] != period or not self.counts[slot]:
+                        means.append(0)
+                  else:
+                        means.append(round(self.sums[3*slot + i] / self.counts[slot]))
+            return means
+
+      #Move the json files of the old one file per measurement history into the log
+      def _migrate(self):
+            files = [file for file in os.listdir(self._dir) if file.startswith('meas_')]
+            if not files:
+                  return
+            import ujson
+            files.sort()
             for file in files:
-                  os.remove(f'./{self._dir}/{file}')
+                  path = f'./{self._dir}/{file}'
+                  try:
+                        with open(path, 'r') as f:
+                              data = ujson.load(f)
+                        data.setdefault('timestamp', int(file.split('_')[1]))
+                        self._write(data)
+                  except (OSError, ValueError):
+                        print(f'Could not migrate {file}')
+                  os.remove(path)
+            print(f'Migrated {len(files)} measurements to the history log')
+            return
+
+      #Empty the history
+      def empty(self):
+            self.pending = []
+            os.remove(self._log)
+            self._create()
+            self._load_rollups()
             return
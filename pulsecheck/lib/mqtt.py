@@ -0,0 +1,200 @@
+import struct
+import socket
+import select
+import errno
+from time import ticks_ms, ticks_diff, ticks_add
+from umqtt.simple import MQTTClient, MQTTException
+
+'''This file contains the MQTT client with a liveness check, umqtt.simple reads PINGRESP but throws it away.
+Pings are sent by keepalive and their answers read without blocking on later calls,
+the round trip times and missed answers are kept so a broker that stopped answering is noticed
+before something is published to it
+
+    client.keepalive()
+    client.alive()
+
+Connecting does not block either, the TCP connection and the CONNACK are polled
+one call at a time so the state machine keeps running while a broker is slow or gone
+
+    client.start_connect()
+    client.poll_connect()
+                    '''
+
+class LiveClient(MQTTClient):
+      PING_MS = 10000 #Time between pings
+      TIMEOUT_MS = 3000 #Ping without an answer in this time is missed
+      MAX_MISSED = 2 #Missed pings in a row before the broker is taken as gone
+      SOCKET_TIMEOUT_S = 2 #Blocking reads and writes give up after this, so a publish to a stalled broker is bounded
+      CONNECT_TIMEOUT_MS = 3000 #Connection and CONNACK within this or the connect fails
+
+      def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.ping_sent = None #Ticks of the ping waiting for an answer
+            self.last_ping = ticks_ms()
+            self.last_pong = None
+            self.missed = 0 #In a row
+            #Statistics
+            self.rtt_ms = None #Last round trip
+            self.rtt_sum, self.pongs, self.failures = 0, 0, 0
+
+      #Open the TCP connection without waiting for it, poll_connect is then called until it returns True.
+      #The server is an IP address, so there is no DNS lookup
+      def start_connect(self, clean_session: bool = True):
+            address = socket.getaddrinfo(self.server, self.port)[0][-1]
+            self.sock = socket.socket()
+            self.sock.setblocking(False)
+            try:
+                  self.sock.connect(address)
+            except OSError as e:
+                  if e.errno != errno.EINPROGRESS:
+                        self.sock.close()
+                        raise
+            self.clean_session = clean_session
+            self.connect_start = ticks_ms()
+            self.connect_sent = False
+            self.poller = select.poll()
+            self.poller.register(self.sock, select.POLLOUT)
+            return
+
+      #Never blocks. Sends CONNECT when the connection is up and reads CONNACK on a later call.
+      #True when connected, raises OSError or MQTTException if it failed and the socket is closed
+      def poll_connect(self) -> bool:
+            try:
+                  return self._poll_connect()
+            except Exception:
+                  self.sock.close()
+                  raise
+
+      def _poll_connect(self) -> bool:
+            if ticks_diff(ticks_ms(), self.connect_start) > self.CONNECT_TIMEOUT_MS:
+                  raise OSError(errno.ETIMEDOUT)
+            events = self.poller.poll(0)
+            if not events:
+                  return False
+            if events[0][1] & (select.POLLERR | select.POLLHUP):
+                  raise OSError(errno.ECONNREFUSED)
+            if not self.connect_sent:
+                  self.sock.write(self._connect_packet())
+                  self.connect_sent = True
+                  self.poller.modify(self.sock, select.POLLIN)
+                  return False
+            resp = self.sock.read(4)
+            if resp is None:
+                  return False
+            if len(resp) != 4 or resp[0] != 0x20 or resp[1] != 0x02:
+                  raise OSError(-1)
+            if resp[3] != 0:
+                  raise MQTTException(resp[3])
+            self.sock.settimeout(self.SOCKET_TIMEOUT_S)
+            self.last_ping = ticks_ms()
+            return True
+
+      #Same CONNECT as umqtt.simple without a user or last will, in one write
+      def _connect_packet(self) -> bytes:
+            client_id = self.client_id if isinstance(self.client_id, bytes) else self.client_id.encode()
+            premsg = bytearray(b"\x10\0\0\0\0\0")
+            msg = bytearray(b"\x04MQTT\x04\x02\0\0")
+            sz = 10 + 2 + len(client_id)
+            msg[6] = self.clean_session << 1
+            msg[7] |= self.keepalive >> 8
+            msg[8] |= self.keepalive & 0x00FF
+            i = 1
+            while sz > 0x7F:
+                  premsg[i] = (sz & 0x7F) | 0x80
+                  sz >>= 7
+                  i += 1
+            premsg[i] = sz
+            return bytes(premsg[:i + 2]) + msg + struct.pack("!H", len(client_id)) + client_id
+
+      #Same as in umqtt.simple, but the round trip is recorded when PINGRESP arrives
+      #and the socket goes back to the timeout instead of blocking for good
+      def wait_msg(self):
+            res = self.sock.read(1)
+            self.sock.settimeout(self.SOCKET_TIMEOUT_S)
+            if res is None:
+                  return None
+            if res == b"":
+                  raise OSError(-1)
+            if res == b"\xd0": #PINGRESP
+                  self.sock.read(1)
+                  self._pong()
+                  return None
+            op = res[0]
+            if op & 0xF0 != 0x30:
+                  return op
+            sz = self._recv_len()
+            topic_len = self.sock.read(2)
+            topic_len = (topic_len[0] << 8) | topic_len[1]
+            topic = self.sock.read(topic_len)
+            sz -= topic_len + 2
+            if op & 6:
+                  pid = self.sock.read(2)
+                  pid = pid[0] << 8 | pid[1]
+                  sz -= 2
+            msg = self.sock.read(sz)
+            self.cb(topic, msg)
+            if op & 6 == 2:
+                  pkt = bytearray(b"\x40\x02\0\0")
+                  struct.pack_into("!H", pkt, 2, pid)
+                  self.sock.write(pkt)
+            return op
+
+      def _pong(self):
+            if self.ping_sent is None: #Late answer to a ping already missed
+                  return
+            self.last_pong = ticks_ms()
+            self.rtt_ms = ticks_diff(self.last_pong, self.ping_sent)
+            self.rtt_sum += self.rtt_ms
+            self.pongs += 1
+            self.missed = 0
+            self.ping_sent = None
+            return
+
+      def _miss(self):
+            self.ping_sent = None
+            self.missed += 1
+            self.failures += 1
+            return
+
+      #The socket failed, there is no point waiting for more pings
+      def _lost(self):
+            self._miss()
+            self.missed = self.MAX_MISSED
+            return
+
+      #Ping now instead of waiting for PING_MS, when the answer is needed soon
+      def ping_now(self):
+            self.last_ping = ticks_add(ticks_ms(), -self.PING_MS)
+            return
+
+      #Never blocks, sends a ping every PING_MS and reads the answer on the next calls. Returns alive()
+      def keepalive(self) -> bool:
+            now = ticks_ms()
+            if self.ping_sent is not None and ticks_diff(now, self.ping_sent) > self.TIMEOUT_MS:
+                  self._miss()
+            if self.ping_sent is None and ticks_diff(now, self.last_ping) >= self.PING_MS:
+                  self.last_ping = now
+                  try:
+                        self.ping()
+                        self.ping_sent = now
+                  except OSError:
+                        self._lost()
+            if self.ping_sent is not None:
+                  try:
+                        self.check_msg()
+                  except OSError: #Closed by the broker
+                        self._lost()
+            return self.alive()
+
+      def alive(self) -> bool:
+            return self.missed < self.MAX_MISSED
+
+      #Round trip times and failures for diagnostics
+      def stats(self) -> dict:
+            return {
+                        "rtt_ms": self.rtt_ms,
+                        "mean_rtt_ms": self.rtt_sum // self.pongs if self.pongs else None,
+                        "pongs": self.pongs,
+                        "failures": self.failures,
+                        "pong_age_ms": ticks_diff(ticks_ms(), self.last_pong) if self.last_pong is not None else None
+                  }
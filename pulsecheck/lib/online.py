@@ -1,26 +1,74 @@
 import network
+import random
 import ntptime
-from time import sleep_ms
+import socket
+import struct
+from machine import RTC
+from time import ticks_ms, ticks_diff, ticks_add, gmtime
 import ujson
 from utility import set_timezone
-from umqtt.simple import MQTTClient
+from mqtt import LiveClient
+from outbox import Outbox
 
 '''This file contains the Online object, no sleeps or loops are used to keep the state machine running'''
 
 '''Connection is established through
-    polling the connect method
+    polling the connect method, one step at a time
+    online.start_connect()
     online.connect()
                     '''
 
 '''When sending kubios message, response must be polled
-    throught the use of listen_kubios method
+    throught the use of listen_kubios method. Responses are matched to
+    requests by the id of the request, the timestamp of the measurement
 
     online.send_kubios(data)
-    online.listen_kubios()
+    online.listen_kubios(id)
+                            '''
+
+'''Requests made without a connection are queued on flash and sent when it is back,
+    also after a restart. Their responses and the ones to requests that were
+    not waited for with expect_kubios are polled separately
+
+    online.queue_kubios(data)
+    online.flush_kubios()
+    online.listen_queued()
+                            '''
+
+'''Data for the hr-data topics goes through the outbox on flash and is sent
+    a bounded time at a time, also when the connection comes back
+
+    online.queue_local(data)
+    online.drain_local()
+                            '''
+
+'''The brokers are pinged in the background, one that stops answering is dropped
+    so is_connected is False before anything is published to it.
+    check_link pings right away when the answer is needed soon, like before a measurement
+
+    online.keepalive()
+    online.check_link()
+    online.link_stats()
+                            '''
+
+'''A lost Wi-Fi or broker is reconnected in the background by polling supervise,
+    attempts are spaced with a jittered exponential backoff. Listeners get
+    'connected' and 'disconnected' events when is_connected changes
+
+    online.on_event(callback)
+    online.supervise()
+    online.retry_now()
                             '''
 
 class Online:
     _instance = None
+    DRAIN_MS = 20 # Time the outbox may use per drain
+    NTP_HOST = "fi.pool.ntp.org" # An IP address here skips the DNS lookup
+    NTP_TIMEOUT_MS = 2000
+    KEEPALIVE_S = 60 # Told to the brokers, they drop the connection after 1.5 times this without traffic
+    WIFI_TIMEOUT_MS = 15000 # Attempt fails if the Wi-Fi is not up in this time
+    BACKOFF_MS = 2000 # Wait after the first failed attempt, doubled after each failure
+    MAX_BACKOFF_MS = 120000
 
     def new(cls, *args, **kwargs):
         if cls._instance is None:
@@ -34,57 +82,209 @@ class Online:
         self.TOPIC = TOPIC
         self.PORT = int(PORT)
         self.connected = False
-        self.received = False
         self.local_mqtt = None
         self.docker_mqtt = None
-        self.kubios_msg = None # Storing the last message here
+        self.connecting = None # Broker client whose connect is being polled
+        self.kubios_sent = set() # Ids of the requests sent, responses not yet received
+        self.kubios_replies = {} # Responses by request id until they are taken
+        self.kubios_request = None # Id of the request a state waits for, listen_queued leaves its response
+        self.outbox = Outbox(2) # Targets: local broker, kubios broker
+        self.kubios_outbox = Outbox(1, 'kubios') # Requests waiting for a connection
+        self.step = 'wifi' # Connection step: wifi, ntp, local, kubios, done
+        self.ntp_socket = None
+        self.ntp_address = None # Looked up once, the lookup blocks
+        self.synced = False # Time set from the server, not asked again on reconnects
+        self.attempt_start = ticks_ms()
+        self.backoff_ms = 0 # Current backoff, 0 after a successful attempt
+        self.retry_at = ticks_ms()
+        self.listeners = []
         
         self.wlan = network.WLAN(network.STA_IF)
         self.wlan.active(True)
         self.wlan.connect(self.SSID, self.PWD)
         
     
+    # Start a new connection, connect is then polled until it returns True
+    def start_connect(self):
+        # Disconnect in case of re-connect press when connection was lost mid machine running
+        for client in (self.local_mqtt, self.docker_mqtt):
+            try:
+                client.disconnect()
+            except:
+                pass
+        self._stop_connecting()
+        self.local_mqtt, self.docker_mqtt = None, None
+        self._set_connected(False)
+        if self.ntp_socket:
+            self.ntp_socket.close()
+            self.ntp_socket = None
+        if not self.wlan.isconnected() and self.wlan.status() != network.STAT_CONNECTING:
+            self.wlan.connect(self.SSID, self.PWD)
+        self.step = 'wifi'
+        self.attempt_start = ticks_ms()
+        return
+
+    # One step of the connection per call, each does a bounded amount of work:
+    # wifi waits for the association, ntp polls the time server, local and kubios poll the connect of one broker each.
+    # Subscribing waits for the answer of the broker at most LiveClient.SOCKET_TIMEOUT_S.
+    # A broker that is already connected is kept
     def connect(self) -> bool:
-        if not self.wlan.isconnected():
-            sleep_ms(50) #Must sleep to await response
-            return False
-        
-        #Time server
+        if self.step == 'wifi':
+            if self.wlan.isconnected():
+                self.step = 'ntp'
+        elif self.step == 'ntp':
+            if self.synced or self._poll_ntp():
+                self.step = 'local'
+        elif self.step == 'local':
+            if self.local_mqtt is None:
+                if not self._connect_mqtt('local', self.PORT):
+                    return False
+                self.local_mqtt, self.connecting = self.connecting, None
+            self.step = 'kubios'
+        elif self.step == 'kubios':
+            if self.docker_mqtt is None:
+                if not self._connect_mqtt('kubios', 21883):
+                    return False
+                self.docker_mqtt, self.connecting = self.connecting, None
+                self._subscribe()
+            self._set_connected(self.local_mqtt is not None or self.docker_mqtt is not None)
+            self._schedule(self.local_mqtt is not None and self.docker_mqtt is not None)
+            self.step = 'done'
+        return self.step == 'done'
+
+    # A new kubios client subscribes again, the broker forgets subscriptions with clean sessions.
+    # Responses to requests sent before that were published to nobody, they are not waited for
+    def _subscribe(self):
+        self.kubios_sent = set()
+        if self.docker_mqtt: # If connected subscribe to correct topic early
+            try:
+                self.docker_mqtt.set_callback(self._kubios_callback) # Calling the class method for callback
+                self.docker_mqtt.subscribe('kubios-response')
+            except Exception as e:
+                print(f"Failed to subscribe: {e}")
+                self.docker_mqtt = None
+        return
+
+    # Plan the next attempt, right after a full success the backoff starts over
+    def _schedule(self, success: bool):
+        if success:
+            self.backoff_ms = 0
+            return
+        self.backoff_ms = min(max(self.backoff_ms * 2, self.BACKOFF_MS), self.MAX_BACKOFF_MS)
+        # Equal jitter, half fixed and half random so devices that lost the same broker do not retry together
+        wait = self.backoff_ms // 2 + random.randint(0, self.backoff_ms // 2)
+        self.retry_at = ticks_add(ticks_ms(), wait)
+        print(f"Reconnecting in {wait} ms")
+        return
+
+    # Never blocks longer than one connect step. Keeps the brokers pinged and reconnects what was lost
+    # when the backoff has passed. Poll it when idle, the states that measure leave reconnecting to it
+    def supervise(self) -> bool:
+        if self.step != 'done': # Attempt in progress
+            if self.step == 'wifi' and ticks_diff(ticks_ms(), self.attempt_start) > self.WIFI_TIMEOUT_MS:
+                print("Wi-Fi not found")
+                self.step = 'done'
+                self._schedule(False)
+            else:
+                self.connect()
+            return self.connected
+        self.keepalive()
+        if self.wlan.isconnected() and self.local_mqtt is not None and self.docker_mqtt is not None and self.connected:
+            return True
+        if ticks_diff(ticks_ms(), self.retry_at) < 0:
+            return self.connected
+        if self.connected and self.wlan.isconnected(): # One broker lost, the other one is kept
+            self.step = 'local'
+            self.attempt_start = ticks_ms()
+        else:
+            self.start_connect()
+        return self.connected
+
+    # Retry on the next supervise without waiting for the backoff
+    def retry_now(self):
+        self.retry_at = ticks_ms()
+        return
+
+    # callback(event) is called with 'connected' or 'disconnected' when is_connected changes
+    def on_event(self, callback):
+        self.listeners.append(callback)
+        return
+
+    def _set_connected(self, connected: bool):
+        if connected == self.connected:
+            return
+        self.connected = connected
+        event = 'connected' if connected else 'disconnected'
+        print(f"Connection event: {event}")
+        for callback in self.listeners:
+            callback(event)
+        return
+
+    # Non-blocking SNTP, the request is sent on the first call and the answer polled on the next ones.
+    # Returns True when done, the time is left as it was if the server does not answer in NTP_TIMEOUT_MS.
+    # The DNS lookup of NTP_HOST blocks, it is done on the first attempt only and the address reused.
+    # If it fails the time is not synced until a restart, so reconnects never wait for DNS
+    def _poll_ntp(self) -> bool:
+        if self.ntp_socket is None:
+            try:
+                if self.ntp_address is None:
+                    self.ntp_address = ()
+                    self.ntp_address = socket.getaddrinfo(self.NTP_HOST, 123)[0][-1]
+                if not self.ntp_address:
+                    return True
+                self.ntp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.ntp_socket.setblocking(False)
+                query = bytearray(48)
+                query[0] = 0x1B # Client request
+                self.ntp_socket.sendto(query, self.ntp_address)
+                self.ntp_start = ticks_ms()
+                return False
+            except Exception:
+                print('Time server not reached, time not in sync')
+                return True
         try:
-            ntptime.host = "fi.pool.ntp.org"
-            ntptime.settime()
-            set_timezone(3)
-        except:
+            msg = self.ntp_socket.recv(48)
+        except OSError: # No answer yet
+            if ticks_diff(ticks_ms(), self.ntp_start) < self.NTP_TIMEOUT_MS:
+                return False
+            msg = None
             print('Time server not reached, time not in sync')
-        
-        #Disconnect in case of re-connect press when connection was lost mid machine running
-        try:
-            self.local_mqtt.disconnect()
-            self.docker_mqtt.disconnect()
-        except:
-            print('MQTT connections already disconnected')
+        self.ntp_socket.close()
+        self.ntp_socket = None
+        if msg:
+            tm = gmtime(struct.unpack("!I", msg[40:44])[0] - ntptime.NTP_DELTA)
+            RTC().datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], 0))
+            set_timezone(3)
+            self.synced = True
+        return True
 
 
-        #MQTT Establish
-        self.local_mqtt = self._connect_mqtt('local', self.PORT)
-        self.docker_mqtt = self._connect_mqtt('kubios', 21883)
-        if self.docker_mqtt: # If connected subscribe to correct topic early
-            self.docker_mqtt.set_callback(self._kubios_callback) # Calling the class method for callback
-            self.docker_mqtt.subscribe('kubios-response')
-            
-        self.connected = True
-        return True
-        
-        
-    # 21883 is the kubios port, and 1883 is the local port for HR-data
-    def _connect_mqtt(self, id: str, port: int) -> object | None:  # Connect to MQTT
+    # 21883 is the kubios port, and 1883 is the local port for HR-data.
+    # Never blocks, the first call starts the connect and the next ones poll it. True when the attempt is over,
+    # the client is then in connecting or it is None if the connect failed
+    def _connect_mqtt(self, id: str, port: int) -> bool:
         try:
-            client = MQTTClient(id, self.IP, port)
-            client.connect(clean_session=True)
+            if self.connecting is None:
+                self.connecting = LiveClient(id, self.IP, port, keepalive=self.KEEPALIVE_S)
+                self.connecting.start_connect(clean_session=True)
+                return False
+            if not self.connecting.poll_connect():
+                return False
             print(f"MQTT connection to {port} successful!")
-            return client
         except Exception as e:
-            raise Exception(f"Failed to connect to MQTT: {e}")
+            print(f"Failed to connect to MQTT: {e}")
+            self.connecting = None
+        return True
+
+    # Give up a connect in progress, for a new attempt
+    def _stop_connecting(self):
+        if self.connecting is not None:
+            try:
+                self.connecting.sock.close()
+            except:
+                pass
+            self.connecting = None
+        return
 
     # Send MQTT message method
     def send_mqtt_message(self, client: object | None, topic: str, data: list):  # Try sending a message when method is called upon. If no connection, give error.
@@ -93,43 +293,155 @@ class Online:
         try:
             client.publish(topic, data)
         except Exception as e:
-            self.connected = False
+            self._set_connected(False)
             raise Exception(f"Failed to send MQTT message: {e}")
     
-    #*TODO* This method needs to ping and confirm that connection is ok *TODO*
+    # Connected to a broker that answers pings, kept up to date by keepalive
     def is_connected(self) -> bool:
         return self.connected
 
-    # Method for listening and awaiting a response from kubios
-    def listen_kubios(self) -> dict | None:
+    # Never blocks, pings both brokers and drops the ones that stopped answering. Returns is_connected
+    def keepalive(self) -> bool:
+        if self.step != 'done':
+            return False
+        for name in ('local_mqtt', 'docker_mqtt'):
+            client = getattr(self, name)
+            if client is None:
+                continue
+            try:
+                alive = client.keepalive()
+            except Exception as e: # Message that failed to parse, the link itself is fine
+                print(e)
+                alive = client.alive()
+            if not alive:
+                print(f"MQTT {client.client_id} not answering: {client.stats()}")
+                self._drop(name)
+        return self.connected
+
+    # Drop one broker, the other one stays up and supervise reconnects only this one
+    def _drop(self, name: str):
+        client = getattr(self, name)
+        print(f"MQTT {client.client_id} connection dropped")
+        try:
+            client.sock.close()
+        except:
+            pass
+        setattr(self, name, None)
+        self._set_connected(self.connected and (self.local_mqtt is not None or self.docker_mqtt is not None))
+        return
+
+    # Ping both brokers on the next keepalive, so the link is known to be up soon after
+    def check_link(self):
+        for client in (self.local_mqtt, self.docker_mqtt):
+            if client is not None:
+                client.ping_now()
+        return
+
+    # Round trip times and failures of the brokers, None for one that is not connected
+    def link_stats(self) -> dict:
+        return {
+            "local": self.local_mqtt.stats() if self.local_mqtt else None,
+            "kubios": self.docker_mqtt.stats() if self.docker_mqtt else None
+        }
+
+    # Receive waiting messages without taking them, listen_kubios and listen_queued return them. True if there are some
+    def poll(self) -> bool:
+        if self.keepalive() and self.docker_mqtt is not None:
+            self._check_kubios()
+        return bool(self.kubios_replies)
+
+    # The response to the request with the id, None until it has come
+    def listen_kubios(self, id: int) -> dict | None:
+        if self.docker_mqtt is not None:
+            self._check_kubios()
+        return self.kubios_replies.pop(id, None)
+
+    # Receive waiting kubios messages, False if the kubios broker was lost and dropped
+    def _check_kubios(self) -> bool:
         try: #To avoid crash if MQTT broker was down and came up again!
             self.docker_mqtt.check_msg()
-        except:
-            self.connected = False
-            return None
-        if not self.received:
-            return None
-        self.received = False
-        return self.kubios_msg
+        except OSError:
+            self._drop('docker_mqtt')
+            return False
+        except Exception as e: # Message that failed to parse
+            print(e)
+        return True
 
+    # A response is kept by the id it answers, one to a request this device did not send is left out
     def _kubios_callback(self, topic, msg):
-        self.received = True
         try:
-            self.kubios_msg = ujson.loads(msg)
+            msg = ujson.loads(msg)
         except Exception as e:
-            self.kubios_msg = None
             raise Exception(f"Failed to parse message: {e}")
+        id = msg.get('id')
+        if id not in self.kubios_sent:
+            print(f"Kubios response to {id} was not waited for")
+            return
+        self.kubios_sent.remove(id)
+        self.kubios_replies[id] = msg
         return
 
-    # Send HRV data to kubios and receive the data message returned by kubios
-    def send_kubios(self, data: dict) -> dict:
-        data = ujson.dumps(data)
-        self.send_mqtt_message(self.docker_mqtt, 'kubios-request', data)
+    # Send HRV data to kubios, listen_kubios with the id of the data returns the response
+    def send_kubios(self, data: dict):
+        self.send_mqtt_message(self.docker_mqtt, 'kubios-request', ujson.dumps(data))
+        self.kubios_sent.add(data['id'])
+        self.kubios_request = data['id']
+        return
+
+    # The response to the request with the id was not waited for, listen_queued takes it when it comes
+    def expect_kubios(self, id: int):
+        if self.kubios_request == id:
+            self.kubios_request = None
         return
     
-    # Send data locally to hr-data topic
-    def send_local(self, data: dict):
-        data = ujson.dumps(data)
-        self.send_mqtt_message(self.local_mqtt, self.TOPIC, data)
-        self.send_mqtt_message(self.docker_mqtt, 'hr-data', data)
+    # Queue a Kubios request on flash to be sent with flush_kubios, the oldest are dropped when the outbox is full
+    def queue_kubios(self, data: dict):
+        self.kubios_outbox.append(ujson.dumps(data))
+        return
+
+    # Send the queued requests for at most budget_ms, stops at the first failure and keeps the rest. Returns the amount sent
+    def flush_kubios(self, budget_ms: int = DRAIN_MS) -> int:
+        if not self.connected or self.docker_mqtt is None:
+            return 0
+        return self.kubios_outbox.drain(0, self._send_queued, budget_ms)
+
+    # Same as send_kubios for a request already encoded in the outbox, its response goes to listen_queued
+    def _send_queued(self, data: str):
+        self.send_mqtt_message(self.docker_mqtt, 'kubios-request', data)
+        self.kubios_sent.add(ujson.loads(data)['id'])
         return
+
+    # A response to a queued request or to one that was not waited for, None when there are none
+    def listen_queued(self) -> dict | None:
+        if self.kubios_sent and self.docker_mqtt is not None:
+            self._check_kubios()
+        for id in self.kubios_replies:
+            if id != self.kubios_request:
+                return self.kubios_replies.pop(id)
+        return None
+
+    # Queue data for the hr-data topics of both brokers, it is encoded once and kept on flash until sent
+    def queue_local(self, data: dict):
+        self.outbox.append(ujson.dumps(data))
+        return
+
+    # Send queued data to the connected brokers for at most budget_ms. Returns the amount of messages sent
+    def drain_local(self, budget_ms: int = DRAIN_MS) -> int:
+        if not self.connected:
+            return 0
+        start = ticks_ms()
+        sent = 0
+        for target, client, topic in ((0, self.local_mqtt, self.TOPIC), (1, self.docker_mqtt, 'hr-data')):
+            left = budget_ms - ticks_diff(ticks_ms(), start)
+            if client is None or left <= 0:
+                continue
+            sent += self.outbox.drain(target, lambda data: self.send_mqtt_message(client, topic, data), left)
+        return sent
+
+    # Messages waiting in the outbox, the most any broker has not received
+    def outbox_depth(self) -> int:
+        return max(self.outbox.depth)
+
+    # Kubios requests waiting for a connection
+    def kubios_depth(self) -> int:
+        return self.kubios_outbox.depth[0]
@@ -0,0 +1,133 @@
+import os
+from time import ticks_ms, ticks_diff
+
+'''This class keeps the messages waiting to be published on flash, so results made offline are sent later.
+Messages are lines appended to outbox.txt. Every target (broker and topic) has its own cursor,
+the offset of its first unsent line in outbox.pos, so a message that reached one target
+is not sent there again if another one fails. The cursor is saved after every publish.
+When every target has sent everything the files are emptied, if the queue grows over MAX_BYTES
+the sent part is dropped and then the oldest messages.
+Queues with other names use their own files, name.txt and name.pos'''
+
+class Outbox:
+      MAX_BYTES = 16384
+
+      def __init__(self, targets: int, name: str = 'outbox'):
+            self._file = f'{name}.txt'
+            self._pos = f'{name}.pos'
+            self.targets = targets
+            self.cursors = [0] * targets
+            self.depth = [0] * targets #Messages each target has not sent
+            self.sent, self.drain_ms = 0, 0 #For throughput
+            try:
+                  with open(self._pos, 'r') as f:
+                        cursors = [int(value) for value in f.read().split()]
+                  if len(cursors) == targets:
+                        self.cursors = cursors
+            except (OSError, ValueError):
+                  pass
+            self._count()
+            return
+
+      #Depth of every target from its cursor, one pass over the queue
+      def _count(self):
+            self.depth = [0] * self.targets
+            offset = 0
+            try:
+                  with open(self._file, 'rb') as f:
+                        for line in f:
+                              for target in range(self.targets):
+                                    if offset >= self.cursors[target]:
+                                          self.depth[target] += 1
+                              offset += len(line)
+            except OSError:
+                  pass
+            return
+
+      def _save(self):
+            with open(self._pos, 'w') as f:
+                  f.write(' '.join(str(cursor) for cursor in self.cursors))
+            return
+
+      def _size(self) -> int:
+            try:
+                  return os.stat(self._file)[6]
+            except OSError:
+                  return 0
+
+      #Add a message for every target, it must not contain newlines (json from ujson.dumps does not)
+      def append(self, message: str):
+            line = message.encode() + b'\n'
+            if self._size() + len(line) > self.MAX_BYTES:
+                  self._compact(len(line))
+            with open(self._file, 'ab') as f:
+                  f.write(line)
+            self.depth = [depth + 1 for depth in self.depth]
+            return
+
+      #Rewrite the queue without the lines every target has sent, then drop the oldest until room bytes fit
+      def _compact(self, room: int):
+            start = min(self.cursors)
+            size = self._size()
+            with open(self._file, 'rb') as src:
+                  src.seek(start)
+                  while size - start + room > self.MAX_BYTES:
+                        line = src.readline()
+                        if not line:
+                              break
+                        start += len(line)
+                        print('Outbox full, oldest message dropped')
+                  with open(self._file + '.new', 'wb') as dst:
+                        while True:
+                              chunk = src.read(512)
+                              if not chunk:
+                                    break
+                              dst.write(chunk)
+            os.remove(self._file)
+            os.rename(self._file + '.new', self._file)
+            self.cursors = [max(cursor - start, 0) for cursor in self.cursors]
+            self._save()
+            self._count()
+            return
+
+      #Publish the messages of a target with publish(message) until there are none or budget_ms has passed.
+      #Stops at the first failure, the message is tried again on the next drain. Returns the amount sent
+      def drain(self, target: int, publish, budget_ms: int) -> int:
+            if not self.depth[target]:
+                  return 0
+            start = ticks_ms()
+            sent = 0
+            with open(self._file, 'rb') as f:
+                  f.seek(self.cursors[target])
+                  while ticks_diff(ticks_ms(), start) < budget_ms:
+                        line = f.readline()
+                        if not line:
+                              break
+                        try:
+                              publish(line[:-1].decode())
+                        except Exception as e:
+                              print(e)
+                              break
+                        self.cursors[target] += len(line)
+                        self.depth[target] -= 1
+                        self._save()
+                        sent += 1
+            self.sent += sent
+            self.drain_ms += ticks_diff(ticks_ms(), start)
+            if not any(self.depth):
+                  self.clear()
+            return sent
+
+      #Messages per second sent while draining
+      def throughput(self) -> float:
+            return self.sent * 1000 / self.drain_ms if self.drain_ms else 0
+
+      def clear(self):
+            for path in (self._file, self._pos):
+                  try:
+                        os.remove(path)
+                  except OSError:
+                        pass
+            self.cursors = [0] * self.targets
+            self.depth = [0] * self.targets
+            return
@@ -4,6 +4,7 @@ from ssd1306 import SSD1306_I2C
 from time import ticks_diff, ticks_ms, sleep_ms
 from piotimer import Piotimer
 import _thread, framebuf
+from array import array
 from animation import logo
 
 '''Lock for multithreading'''
@@ -11,6 +12,8 @@ lock = _thread.allocate_lock()
 
 '''This file contains all the I/O hardware peripherals for the project and their interfaces'''
 class Screen(SSD1306_I2C):
+      PLOT_POINTS = 32 #Plot points core0 can queue before core1 draws them, 0.6 s at 50 points/s
+
       def __init__(self, da: int, cl: int):
 
             #I2C init
@@ -27,9 +30,14 @@ class Screen(SSD1306_I2C):
             self.last_draw = ticks_ms()
             self.dots_str = ''
 
-            #Measuring draw variables
+            #Measuring draw variables, plot points are queued so the ones of a multi-sample pass are all drawn
+            self.plot_x = array('h', (0 for _ in range(self.PLOT_POINTS)))
+            self.plot_y = array('h', (0 for _ in range(self.PLOT_POINTS)))
+            self.plot_len = 0
+            self.x, self.y = -1, 16
             self.hr_plot_pos(-1, 16)
             self.hr_bpm(0)
+            self.hrv_live(0, 0)
             self.y_old = 0
             self.ppi_flag = False
 
@@ -37,13 +45,19 @@ class Screen(SSD1306_I2C):
             self.items_request = False
             self.cursor_pos(0)
 
+            #Trend chart variables
+            self.chart_request = False
+
             #Screen init
             super().__init__(self.width, self.heigth, i2c)
             
       def _draw_hr(self): # -2 and -1 offset to fix refresh bar issue
-            self.fill_rect(self.x-1, 0, 12, 48, 0)
-            self.line(self.x-2, self.y_old, self.x-1, self.y, 1)
-            self.y_old = self.y
+            for i in range(self.plot_len):
+                  self.x, self.y = self.plot_x[i], self.plot_y[i]
+                  self.fill_rect(self.x-1, 0, 12, 48, 0)
+                  self.line(self.x-2, self.y_old, self.x-1, self.y, 1)
+                  self.y_old = self.y
+            self.plot_len = 0
             return
 
       def _draw_bpm(self):
@@ -54,6 +68,11 @@ class Screen(SSD1306_I2C):
                   self.text(f"avg BPM: {self.bpm}", 0, 56, 1)
             return
       
+      def _draw_hrv(self):
+            self.fill_rect(0, 56, 128, 8, 0)
+            self.text(f'RMSSD {self.rmssd} SDNN {self.sdnn}', 0, 56, 1)
+            return
+
       def _draw_items(self):
             for i in range(len(self.items_)):
                   self.text(self.items_[i], self.offset, i*8, 1)
@@ -64,6 +83,24 @@ class Screen(SSD1306_I2C):
             self.text('>', 0, self.pos*8, 1)
             return
       
+      #Bars of the values scaled between their min and max under the title, 0 is a gap
+      def _draw_chart(self):
+            self.fill(0)
+            values = [value for value in self.chart_values if value]
+            if not values:
+                  self.text(self.chart_title, 0, 0, 1)
+                  self.text('No data', 0, 28, 1)
+                  return
+            low, high = min(values), max(values)
+            self.text(f'{self.chart_title} {low}-{high}', 0, 0, 1)
+            span = max(high - low, 1)
+            width = self.width // len(self.chart_values)
+            for i, value in enumerate(self.chart_values):
+                  if value:
+                        bar = 2 + (value - low) * 50 // span
+                        self.fill_rect(i*width, self.heigth - bar, max(width - 1, 1), bar, 1)
+            return
+
       def _draw_measure(self):
             self._draw_hr()
             if self.ppi_flag: #For drawing X when a peak detected
@@ -102,7 +139,7 @@ class Screen(SSD1306_I2C):
                         self._draw_items()
                         self.items_request = False
                   #Screen modes, 0 = active measuring, 1 = menu mode,
-                  #2 = analysis measuring, 3 = static view, 4 = loading anim, 5 = startup
+                  #2 = analysis measuring, 3 = static view, 4 = loading anim, 5 = startup, 6 = trend chart
                   elif self.mode == 0:
                         self._draw_measure()
                         self._draw_bpm()
@@ -112,8 +149,11 @@ class Screen(SSD1306_I2C):
 
                   elif self.mode == 2:
                         self._draw_measure()
-                        self._draw_dot_animation(3)
-                        self.text(f'Analysing {self.dots_str}', 0, 56, 1)
+                        if self.rmssd:
+                              self._draw_hrv()
+                        else:
+                              self._draw_dot_animation(3)
+                              self.text(f'Analysing {self.dots_str}', 0, 56, 1)
 
                   elif self.mode == 3:
                         pass
@@ -125,6 +165,10 @@ class Screen(SSD1306_I2C):
                   elif self.mode == 5:
                         self._draw_start_animation()
 
+                  elif self.mode == 6 and self.chart_request:
+                        self._draw_chart()
+                        self.chart_request = False
+
             #Buggy shit, use this to keep from crashing still :(
             try:
                   self.show()
@@ -134,10 +178,13 @@ class Screen(SSD1306_I2C):
                   
 
       '''These methods under here are used as a interface for core0 communicating to core1 to draw things'''
+      #Queue a plot point, if core1 has fallen PLOT_POINTS behind the newest replaces the last one
       def hr_plot_pos(self, x: int, y: int):
             with lock:
-                  self.x = x
-                  self.y = y
+                  i = min(self.plot_len, self.PLOT_POINTS - 1)
+                  self.plot_x[i] = x
+                  self.plot_y[i] = y
+                  self.plot_len = i + 1
             return
       
       def hr_bpm(self, bpm: int):
@@ -145,6 +192,13 @@ class Screen(SSD1306_I2C):
                   self.bpm = bpm
             return
       
+      #Live HRV values for the analysis measuring view, 0 shows the analysing animation
+      def hrv_live(self, rmssd: int, sdnn: int):
+            with lock:
+                  self.rmssd = rmssd
+                  self.sdnn = sdnn
+            return
+
       def cursor_pos(self, pos: int):
             with lock:
                   self.pos = pos
@@ -161,6 +215,14 @@ class Screen(SSD1306_I2C):
             with lock:
                   self.empty_request = True
             return
+
+      #Chart drawn once in the trend chart mode
+      def chart(self, title: str, values: list):
+            with lock:
+                  self.chart_title = title
+                  self.chart_values = values
+                  self.chart_request = True
+            return
       
       def ppi(self):
             with lock:
@@ -169,20 +231,36 @@ class Screen(SSD1306_I2C):
       
       
       #Screen modes, 0 = measuring, 1 = menu mode,
-      #2 = analysis view, 3 = static view, 4 = loading anim, 5 = startup
+      #2 = analysis view, 3 = static view, 4 = loading anim, 5 = startup, 6 = trend chart
       def set_mode(self, mode: int):
-            if mode < 0 or mode > 5:
-                  raise ValueError('Screen mode not correct, 0 = Measuring, 1 = Menu, 2 = Analysis view, 3 = Static view, 4 = Loading anim, 5 = Startup')
+            if mode < 0 or mode > 6:
+                  raise ValueError('Screen mode not correct, 0 = Measuring, 1 = Menu, 2 = Analysis view, 3 = Static view, 4 = Loading anim, 5 = Startup, 6 = Trend chart')
             self.empty()
             with lock:
                   self.mode = mode
             return
 
             
+#Input fifo that can wake the asyncio runtime, the flag is set from the irqs when one is given
+class WakingFifo(Fifo):
+      flag = None
+
+      def put(self, value: int):
+            Fifo.put(self, value) #Not super(), nothing may be allocated in a hard irq
+            if self.flag is not None:
+                  self.flag.set()
+            return
+
+
 class Isr_fifo(Fifo):
       def __init__(self, size: int, adc_pin: int):
             self.av = ADC(adc_pin)
             super().__init__(size)
+
+      #Fifo size that holds the samples of the worst state machine pass with headroom, one slot is always empty
+      @staticmethod
+      def size_for(hz: int, worst_pass_ms: int, headroom: int = 2) -> int:
+            return hz * worst_pass_ms * headroom // 1000 + 1
       
       def init_timer(self, hz=250):
             self.tmr = Piotimer(mode=Piotimer.PERIODIC, freq=hz, callback=self._handler)
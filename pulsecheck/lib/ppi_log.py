@@ -0,0 +1,172 @@
+import os, struct
+
+'''This file stores the PPI series behind the history records so they can be analysed again later.
+A series is delta encoded: the count, then every PPI minus the previous one as a zigzag varint,
+1 byte for changes under 64 ms and 2 bytes for the rest. The first PPI is a change from 0.
+Series are appended to a ring of a fixed size, so the oldest ones are overwritten first.
+The pointers to them are kept in the same slots as the history log records
+
+Ring layout, little endian:
+    header  bytes written in total, ring size
+    data    the series back to back, wrapping at the ring size
+Pointer slots:
+    seq number, position in the total written, length in bytes'''
+
+def zigzag(value: int) -> int:
+      return value << 1 if value >= 0 else (-value << 1) - 1
+
+def unzigzag(value: int) -> int:
+      return -((value + 1) >> 1) if value & 1 else value >> 1
+
+def _varint(out: bytearray, value: int):
+      while value > 0x7F:
+            out.append(value & 0x7F | 0x80)
+            value >>= 7
+      out.append(value)
+      return
+
+def encode(ppi: list) -> bytearray:
+      out = bytearray()
+      _varint(out, len(ppi))
+      prev = 0
+      for value in ppi:
+            _varint(out, zigzag(value - prev))
+            prev = value
+      return out
+
+
+#A stored series, iterating it decodes it from flash a chunk at a time so it is never a list.
+#Can be iterated many times and has a length, so the analysis functions take it like a list
+class PpiSeries:
+      CHUNK = 64
+
+      def __init__(self, path: str, header_size: int, ring_size: int, start: int, length: int):
+            self.path = path
+            self.header_size = header_size
+            self.ring_size = ring_size
+            self.start = start
+            self.length = length
+            self.count = 0
+            for count in self._varints():
+                  self.count = count
+                  break
+
+      #Bytes of the series, the file is opened for every chunk so an unfinished iteration leaves nothing open
+      def _bytes(self):
+            done = 0
+            while done < self.length:
+                  pos = (self.start + done) % self.ring_size
+                  size = min(self.CHUNK, self.length - done, self.ring_size - pos)
+                  with open(self.path, 'rb') as f:
+                        f.seek(self.header_size + pos)
+                        chunk = f.read(size)
+                  for byte in chunk:
+                        yield byte
+                  done += size
+
+      def _varints(self):
+            value, shift = 0, 0
+            for byte in self._bytes():
+                  value |= (byte & 0x7F) << shift
+                  shift += 7
+                  if not byte & 0x80:
+                        yield value
+                        value, shift = 0, 0
+
+      def __len__(self) -> int:
+            return self.count
+
+      def __iter__(self):
+            values = self._varints()
+            next(values) #Count
+            prev = 0
+            for value in values:
+                  prev += unzigzag(value)
+                  yield prev
+
+
+class PpiLog:
+      _ring = 'hist/ppi.bin'
+      _pointers = 'hist/ppi.idx'
+      HEADER = '<II'
+      POINTER = '<IIH'
+
+      def __init__(self, ring_kb: int):
+            self.header_size = struct.calcsize(self.HEADER)
+            self.pointer_size = struct.calcsize(self.POINTER)
+            self.size = ring_kb * 1024 - self.header_size
+            size = None
+            try:
+                  with open(self._ring, 'rb') as f:
+                        header = f.read(self.header_size)
+                  if len(header) == self.header_size:
+                        self.written, size = struct.unpack(self.HEADER, header)
+            except OSError:
+                  pass
+            if size != self.size:
+                  if size is not None:
+                        print('PPI ring size changed, stored series dropped')
+                  self.clear()
+            return
+
+      def clear(self):
+            self.written = 0
+            with open(self._ring, 'wb') as f:
+                  f.write(struct.pack(self.HEADER, self.written, self.size))
+            open(self._pointers, 'wb').close()
+            return
+
+      #Append the series of record seq in slot, the data in at most two writes and the header in one
+      def write(self, seq: int, slot: int, ppi: list):
+            data = encode(ppi)
+            length = len(data)
+            if length > min(self.size, 0xFFFF):
+                  print('PPI series too long to store')
+                  return
+            start = self.written
+            pos = start % self.size
+            first = min(length, self.size - pos)
+            with open(self._ring, 'r+b') as f:
+                  f.seek(self.header_size + pos)
+                  f.write(data[:first])
+                  if first < length:
+                        f.seek(self.header_size)
+                        f.write(data[first:])
+                  self.written += length
+                  f.seek(0)
+                  f.write(struct.pack(self.HEADER, self.written, self.size))
+            with open(self._pointers, 'r+b') as f:
+                  f.seek(slot * self.pointer_size)
+                  f.write(struct.pack(self.POINTER, seq, start, length))
+            return
+
+      #Series of record seq in slot, None if it was not stored or has been overwritten
+      def read(self, seq: int, slot: int) -> PpiSeries | None:
+            try:
+                  with open(self._pointers, 'rb') as f:
+                        f.seek(slot * self.pointer_size)
+                        pointer = f.read(self.pointer_size)
+            except OSError:
+                  return None
+            if len(pointer) < self.pointer_size: #Slots after the last stored series
+                  return None
+            stored, start, length = struct.unpack(self.POINTER, pointer)
+            if stored != seq or self.written - start > self.size:
+                  return None
+            return PpiSeries(self._ring, self.header_size, self.size, start, length)
+
+      #Move pointers when the history log is resized, moves are (old slot, old seq, new seq) and the new slot is new seq - 1
+      def renumber(self, moves):
+            new = self._pointers + '.new'
+            with open(self._pointers, 'rb') as src, open(new, 'wb') as dst:
+                  for slot, old, seq in moves:
+                        src.seek(slot * self.pointer_size)
+                        pointer = src.read(self.pointer_size)
+                        if len(pointer) < self.pointer_size or struct.unpack_from('<I', pointer)[0] != old:
+                              pointer = bytes(self.pointer_size)
+                        else:
+                              pointer = struct.pack('<I', seq) + pointer[4:]
+                        dst.write(pointer)
+            os.remove(self._pointers)
+            os.rename(new, self._pointers)
+            return
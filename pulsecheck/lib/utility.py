@@ -1,5 +1,4 @@
 from time import localtime, mktime
-from machine import RTC
 import re
 
 def format_filenames(files: list) -> list:
@@ -17,14 +16,14 @@ def format_data(data: dict) -> list:
       for d in data:
             if d == 'timestamp': #Ajan formatointi h:m, lisää nollia minuutteihin
                   time = localtime(data[d])
-                  time = f'{time[3]}:{'{:0>{w}}'.format(str(time[4]), w=2)}'
+                  time = f'{time[3]}:{time[4]:02}'
                   formatted.insert(0, f'TIME: {time}')
             elif d != 'id': #Print all but id
                   formatted.append(f'{d.upper()}: {data[d]}')
       return formatted
 
-def format_kubios_message(ppi: list) -> dict:
-            stamp = mktime(localtime())
+#The id is the timestamp of the measurement, Kubios returns it with the response
+def format_kubios_message(ppi: list, stamp: int) -> dict:
             data =  {
                         "id": stamp,
                         "type": "RRI",
@@ -33,8 +32,9 @@ def format_kubios_message(ppi: list) -> dict:
                   }
             return data
 
+#Result of a Kubios response, timestamped with the measurement it answers
 def parse_kubios_message(data: dict) -> dict:
-      stamp = mktime(localtime())
+      stamp = data.get('id', mktime(localtime()))
       data = data['data']['analysis']
       data = {
                   "id": stamp,
@@ -49,11 +49,9 @@ def parse_kubios_message(data: dict) -> dict:
             }
       return data
 
-def calculate_plotting_values(samples: list) -> tuple[int, float]:
-      #Calculate scaling factor
-      max_list = max(samples)
-      min_list = min(samples)
-      scale_fc = 42 / (max_list - min_list)
+def calculate_plotting_values(max_list: int, min_list: int) -> tuple[int, float]:
+      #Calculate scaling factor from the window min and max, flat signal would divide by zero
+      scale_fc = 42 / max(max_list - min_list, 1)
       return max_list, scale_fc
 
 
@@ -70,7 +68,21 @@ def read_wifi_file() -> dict:
                   parameters[match.groups()[0]] = match.groups()[1]
       return parameters
 
+#Worst state machine pass measured while sampling, the adc fifo is sized for it on boot
+def read_worst_pass(default: int) -> int:
+      try:
+            with open('worst_pass.txt', 'r') as file:
+                  return max(default, int(file.read()))
+      except (OSError, ValueError):
+            return default
+
+def save_worst_pass(ms: int):
+      with open('worst_pass.txt', 'w') as file:
+            file.write(str(ms))
+      return
+
 def set_timezone(timezone: int):
+      from machine import RTC #Imported here so the other helpers can be used on a PC
       
       #Get current time tuple, change the 3rd index
       tm = list(localtime())
@@ -7,6 +7,9 @@ from hardware import HardwareConfig
 import micropython
 micropython.alloc_emergency_exception_buf(200)
 
+'''Set True to run the states with the experimental asyncio runtime of runtime.py instead of the polling loop below'''
+ASYNC_RUNTIME = False
+
 '''Init the hardware objects'''
 hardware = HardwareConfig()
 
@@ -30,16 +33,21 @@ class PulseCheck:
                   return None
             return self.fifo.get()
 
+      #The brokers are pinged on every pass whatever the state, they drop a client that is silent for too long
       def execute(self):
             with self.next_state as current_state:
                   while self.next_state == current_state:
                         input = self.get_input()
+                        hardware.online.keepalive()
                         self.next_state = current_state.run(input)
 
 
 
 '''Here is the main program of the PulseCheck, has a simple state machine hopefully :/'''
 second_thread = _thread.start_new_thread(core1_thread, ())
+if ASYNC_RUNTIME:
+      from runtime import AsyncPulseCheck
+      AsyncPulseCheck().start()
 machine_ = PulseCheck()
 while True:
       machine_.execute()
@@ -0,0 +1,121 @@
+import time
+try:
+      import asyncio
+except ImportError:
+      import uasyncio as asyncio # type: ignore
+from hardware import HardwareConfig
+from state_machine.states import LogoState, ConnectState
+from state_machine.measure import Measure
+'''This file contains the optional asyncio runtime of the PulseCheck, an opt-in experiment, set ASYNC_RUNTIME in main.py to use it'''
+
+'''The states are the same as with the polling loop of main.py, but run is only called when there is
+something to do: an input, samples in the adc fifo, a MQTT message or the tick that keeps the timeouts going.
+The inputs, adc, MQTT, connection and historian are separate tasks that wake the state task,
+between them the core sleeps in the asyncio loop instead of polling.
+It cuts the time spent in the states, it does not make inputs faster: tools/sim_runtime.py measures a higher
+input latency than the polling loop on a PC, and it has not been measured on the device
+
+    AsyncPulseCheck().start()
+                                    '''
+
+#ThreadSafeFlag can be set from the input irqs, asyncio of CPython for the simulation only has Event
+def _flag() -> object:
+      if hasattr(asyncio, 'ThreadSafeFlag'):
+            return asyncio.ThreadSafeFlag()
+      return asyncio.Event()
+
+async def _wait(flag: object):
+      await flag.wait()
+      if hasattr(flag, 'clear'): #ThreadSafeFlag clears itself
+            flag.clear()
+      return
+
+async def _sleep_ms(ms: int):
+      if hasattr(asyncio, 'sleep_ms'):
+            await asyncio.sleep_ms(ms)
+      else:
+            await asyncio.sleep(ms / 1000)
+      return
+
+class AsyncPulseCheck:
+      TICK_MS = 100 #State timeouts and animations are checked this often
+      ADC_MS = 20 #Samples are processed this often while measuring, 5 samples at 250 Hz
+      MQTT_MS = 100
+      CONNECT_MS = 100
+      FLUSH_MS = 1000
+
+      hardware = HardwareConfig()
+
+      def __init__(self, initial_state: object = None):
+            self.next_state = initial_state if initial_state is not None else LogoState()
+            self.current = None
+            self.inputs = []
+            self.wake = asyncio.Event() #Set by the tasks when the state has something to do
+            self.input_flag = _flag()
+            self.hardware.fifo.flag = self.input_flag
+            #Statistics, run calls and the time spent in them
+            self.runs, self.busy_us = 0, 0
+
+      async def _inputs(self):
+            fifo = self.hardware.fifo
+            while True:
+                  await _wait(self.input_flag)
+                  while not fifo.empty():
+                        self.inputs.append(fifo.get())
+                  self.wake.set()
+
+      async def _adc(self):
+            while True:
+                  await _sleep_ms(self.ADC_MS)
+                  if isinstance(self.current, Measure) and not self.hardware.adc.empty():
+                        self.wake.set()
+
+      async def _tick(self):
+            while True:
+                  await _sleep_ms(self.TICK_MS)
+                  self.wake.set()
+
+      #Kubios messages are received here, the states take them with listen_kubios. Pings the brokers in every state
+      async def _mqtt(self):
+            while True:
+                  await _sleep_ms(self.MQTT_MS)
+                  if self.hardware.online.poll():
+                        self.wake.set()
+
+      #Keeps the connection up in the background when ConnectState is not connecting, not while measuring
+      async def _connection(self):
+            online = self.hardware.online
+            while True:
+                  await _sleep_ms(self.CONNECT_MS)
+                  if not isinstance(self.current, (ConnectState, Measure)):
+                        online.supervise()
+
+      async def _flush(self):
+            while True:
+                  await _sleep_ms(self.FLUSH_MS)
+                  if not isinstance(self.current, Measure):
+                        self.hardware.historian.flush()
+
+      async def _states(self):
+            while True:
+                  with self.next_state as current:
+                        self.current = current
+                        self.wake.set() #Run once on entry
+                        while self.next_state == current:
+                              await _wait(self.wake)
+                              input = self.inputs.pop(0) if self.inputs else None
+                              start = time.ticks_us()
+                              self.next_state = current.run(input)
+                              self.busy_us += time.ticks_diff(time.ticks_us(), start)
+                              self.runs += 1
+                              if self.inputs:
+                                    self.wake.set()
+
+      async def main(self):
+            for task in (self._inputs, self._adc, self._tick, self._mqtt, self._connection, self._flush):
+                  asyncio.create_task(task())
+            await self._states()
+
+      def start(self):
+            asyncio.run(self.main())
+            return
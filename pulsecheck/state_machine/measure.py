@@ -1,49 +1,70 @@
 from .template_state import State
 import time
 from lib import utility # type: ignore
+from lib import dsp # type: ignore
+#The per sample classes compiled with the native emitter when the port has it, same interface as lib.dsp
+try:
+      from lib import dsp_native as dsp_impl # type: ignore
+except (ImportError, SyntaxError, NotImplementedError):
+      dsp_impl = dsp
 
 #Class for states with measuring functionality
 class Measure(State):
+      #Place the peak between samples where the envelope crossed the threshold
+      interpolate = True
+      #Print the fifo statistics on exit
+      debug = False
+
       def __init__(self):
-            #For peak find algorithm
-            self.edge = False
-            self.peak_time = time.ticks_ms()
-            self.prev_peak_time = time.ticks_ms()
-            self.threshold = 0
+            #For peak find algorithm, peak times are sample indexes so they do not depend on when the sample was processed
+            self.hz = self.hardware.ADC_HZ
+            self.peak_time = 0
+            self.prev_peak_time = 0
+            #Integer band-pass and envelope, the detector finds threshold crossings of the envelope over 2 seconds
+            self.filter = dsp_impl.PulseFilter(self.hz)
+            self.detector = dsp_impl.PeakDetector(500)
             #For plotting the screen
             self.max_list, self.scale_fc, self.sample_num = 0, 0, 0
-            #Samples: for drawing and threshold calculating
-            self.samples, self.PPI = [], []
+            self.PPI = []
+            #Min and max of the band-passed signal over 2 seconds for plot scaling, the newest sample is filter.filtered
+            self.window = dsp_impl.WindowMinMax(500, 'h')
             self.x, self.y = 0, 0
-            self.got_data = False
             #To calculate the bpm flag
             self.peak_appended = False
+            #Fifo statistics, overruns are samples the isr dropped because the fifo was full
+            self.overruns, self.max_batch = 0, 0
+            self.dropped_start = self.hardware.adc.dropped()
+            self.worst_pass = 0
+            #Save queued history before sampling starts so flash writes do not delay the first passes
+            self.hardware.historian.flush()
+            self.last_pass = time.ticks_ms() #After the flush so it is not counted in the first pass
             #Start sample reading
-            self.hardware.adc.init_timer(250)
+            self.hardware.adc.init_timer(self.hardware.ADC_HZ)
 
       def _read_sample_to_list(self) -> bool:
             if self.hardware.adc.empty():
                   return False
-            self.samples.append(self.hardware.adc.get()) #O(1) op
+            self.filter.push(self.hardware.adc.get()) #O(1) op, integers only
+            self.window.push(self.filter.filtered) #O(1) amortised
             self.sample_num += 1
-            self.got_data = True
             return True
 
+      #Process every sample waiting in the fifo, so one slow pass of the state machine does not drop samples
       def measure(self, MAX_PPI_SIZE: int):
-            if not self._read_sample_to_list():
-                  return
-            
-            if self.sample_num % 250 == 0:
-                  self.max_list, self.scale_fc = utility.calculate_plotting_values(self.samples[:250])
-            
-            if len(self.samples) < 500:
-                  return
+            now = time.ticks_ms()
+            self.worst_pass = max(self.worst_pass, time.ticks_diff(now, self.last_pass))
+            self.last_pass = now
 
-            self._find_ppi()
-            del self.samples[0] #O(n) op
+            batch = 0
+            while self._read_sample_to_list():
+                  batch += 1
+                  self.display_data()
+                  self._find_ppi()
+                  if len(self.PPI) > MAX_PPI_SIZE:
+                        del self.PPI[0]
 
-            if len(self.PPI) > MAX_PPI_SIZE:
-                  del self.PPI[0]
+            self.max_batch = max(self.max_batch, batch)
+            self.overruns = self.hardware.adc.dropped() - self.dropped_start
             return
 
       def accept_ppi_to_list(self, ppi: int):
@@ -52,48 +73,45 @@ class Measure(State):
             self.hardware.screen.ppi()
             self.PPI.append(ppi)
             self.peak_appended = True
+            self.on_ppi(ppi)
 
-      def _find_ppi(self):
-            
-            if self.sample_num % 125 == 0:
-                  max_val = max(self.samples)
-                  min_val = min(self.samples)
-                  amplitude = max_val - min_val
-                  self.threshold = min_val + amplitude*0.6
-            
-            
-            #Rolling average of 10 last
-            data = self.samples[-10:]
-            sample = sum(data)/len(data)
+      #Called with every accepted PPI, for states that process beats as they come
+      def on_ppi(self, ppi: int):
+            pass
 
-            data2 = self.samples[-20:-10]
-            sample2 = sum(data2)/len(data2)
+      def _find_ppi(self):
+            crossing = self.detector.push(self.filter.envelope)
 
             #Rising edge detected, appends to PPI list if the value is acceptable
-            if sample > self.threshold and sample2 - sample <= 0 and not self.edge:
-                  self.peak_time = time.ticks_ms()
-                  self.edge = True
-                  self.accept_ppi_to_list(time.ticks_diff(self.peak_time, self.prev_peak_time))
-                  return
-            
+            if crossing > 0:
+                  self.peak_time = self.sample_num
+                  if self.interpolate:
+                        self.peak_time -= self.detector.fraction()
+                  self.accept_ppi_to_list(round((self.peak_time - self.prev_peak_time) * 1000 / self.hz))
+
             #Falling under threshold with detection flag on, reset.
-            elif sample < self.threshold and self.edge:
+            elif crossing < 0:
                   self.prev_peak_time = self.peak_time
-                  self.edge = False
             return
-      
+
+      #Called for every sample from measure, plots every 5th
       def display_data(self):
-            if self.sample_num < 500 or self.sample_num % 5 != 0 or not self.got_data:
+            if self.sample_num < 500 or self.sample_num % 5 != 0:
                   return
-            self.y = utility.plot_sample(self.samples[-1], self.max_list, self.scale_fc)
+            self.max_list, self.scale_fc = utility.calculate_plotting_values(self.window.max, self.window.min)
+            self.y = utility.plot_sample(self.filter.filtered, self.max_list, self.scale_fc)
             self.y = min(max(0, self.y), 41)
             self.hardware.screen.hr_plot_pos(self.x, self.y)
             self.x = (self.x + 1) % self.hardware.screen.width
-            self.got_data = False
             return
       
       def __exit__(self, exc_type, exc_value, traceback):
             self.hardware.screen.hr_plot_pos(-1, 16) #To fix wild pixel upon re-entering measuring
             self.hardware.screen.hr_bpm(0)
+            self.hardware.screen.hrv_live(0, 0)
             self.hardware.adc.deinit_timer()
+            if self.worst_pass > self.hardware.WORST_PASS_MS: #The adc fifo is sized for it on the next boot
+                  utility.save_worst_pass(self.worst_pass)
+            if self.debug:
+                  print(f'ADC fifo overruns: {self.overruns}, worst pass: {self.worst_pass} ms, biggest batch: {self.max_batch}')
             return
@@ -38,77 +38,110 @@ class ErrorState(State):
 class MeasureHrState(Measure):
       def __enter__(self) -> object:
             self.hardware.screen.set_mode(0)
-            self.bpm = 0
-            self.filtered_ppi = []
+            self.live_hr = analysis.LiveHr(10, percent=0.3)
             return super().__enter__()
 
-      def display_data(self):
-            Measure.display_data(self)
-            if not self.peak_appended or len(self.PPI) < 5:
-                  return
-            self.peak_appended = False
-            self.filtered_ppi = analysis.preprocess_ppi(self.PPI, percent=0.3)
-            if self.filtered_ppi:
-                  self.bpm = round(analysis.mean_hr(self.filtered_ppi))
-                  self.hardware.screen.hr_bpm(self.bpm)
+      #BPM is updated per beat, a rejected beat keeps the previous value on screen
+      def on_ppi(self, ppi: int):
+            if self.live_hr.push(ppi) and self.live_hr.bpm():
+                  self.hardware.screen.hr_bpm(self.live_hr.bpm())
             return
 
       def run(self, input: int | None) -> object:
             self.measure(20)
-            self.display_data()
             if input == self.hardware.ROT_PUSH:
                   self.state = MenuState()
             return self.state
 
 #Special case where init is used to get the data to be uploaded to local server history
+#Results are queued on flash and sent right away if connected, the menu sends the rest when the connection is back
 class UploadToLocal(State):
       def __init__(self, data: dict):
             self.data = data
 
       def run(self, input: int | None) -> object:
             try:
-                  self.hardware.online.send_local(self.data)
+                  self.hardware.online.queue_local(self.data)
+                  self.hardware.online.drain_local()
                   self.state = MenuState()
             except:
                   self.state = ErrorState(['Local Upload', 'Fail'])
             return self.state
 
-#Special case where init is used to get the data to be drawn on entry
-class ViewAnalysisState(State):
-      def __init__(self, data: dict):
+#Template for static views of results, rotary scrolls the lines that do not fit on the screen
+class ScrollView(State):
+      LINES = 8 #8px font on a 64px screen
+
+      def show(self, lines: list):
+            self.lines = lines
+            self.top = 0
+            self.hardware.screen.items(self.lines, offset=0)
+            self.hardware.screen.set_mode(3)
+            return
+
+      def scroll(self, input: int | None):
+            if input != 1 and input != -1: #Rotary
+                  return
+            top = min(max(0, self.top + input), max(0, len(self.lines) - self.LINES))
+            if top == self.top:
+                  return
+            self.top = top
+            self.hardware.screen.empty()
+            self.hardware.screen.items(self.lines[top:], offset=0)
+            return
+
+
+#Special case where init is used to get the data to be drawn on entry, the PPI it came from is saved with it
+class ViewAnalysisState(ScrollView):
+      def __init__(self, data: dict, ppi: list | None = None):
             self.data = data
+            self.ppi = ppi
 
       def __enter__(self) -> object:
-            self.hardware.historian.write(self.data)
-            data = utility.format_data(self.data)
-            self.hardware.screen.items(data, offset=0)
-            self.hardware.screen.set_mode(3)
+            self.hardware.historian.write(self.data, self.ppi)
+            self.show(utility.format_data(self.data))
             return State.__enter__(self)
 
       def run(self, input: int | None) -> object:
             if input == self.hardware.ROT_PUSH:
                   self.state = UploadToLocal(self.data)
+            else:
+                  self.scroll(input)
             return self.state
 
 
+#Every beat of the 30 s is kept and saved with the results, the time and frequency domain are of the beats the accumulator took
 class HrvAnalysisState(Measure):
+      MAX_PPI = 120 #30 s of the shortest accepted PPI, so no beat is dropped
+
       def __enter__(self) -> object:
             self.start_time = time.ticks_ms()
             self.timeout = 30000 #ms
+            self.hrv = analysis.HrvAccumulator()
             self.hardware.screen.set_mode(2)
             return super().__enter__()
-      
+
+      #Results are accumulated per beat, shown live once there are a few
+      def on_ppi(self, ppi: int):
+            if self.hrv.push(ppi) and self.hrv.count >= 5:
+                  self.hardware.screen.hrv_live(round(self.hrv.rmssd()), round(self.hrv.sdnn()))
+            return
+
       def analysis(self) -> object:
             try:
-                  data = analysis.full(self.PPI)
-                  self.state = ViewAnalysisState(data)
+                  data = self.hrv.results()
             except:
                   self.state = ErrorState(['Bad Data'])
+                  return self.state
+            try:
+                  data.update(analysis.frequency(self.hrv.beats))
+            except ValueError: #Too few beats left for the frequency domain, shown without LF/HF
+                  pass
+            self.state = ViewAnalysisState(data, self.PPI)
             return self.state
 
       def run(self, input: int | None) -> object:
-            self.measure(50)
-            self.display_data()
+            self.measure(self.MAX_PPI)
             if not self.peak_appended: #Start counting time when first peak is appended
                   self.start_time = time.ticks_ms()
             if input == self.hardware.ROT_PUSH:
@@ -119,7 +152,15 @@ class HrvAnalysisState(Measure):
             return self.state
 
 
+#Waits for the Kubios response, the local estimate is shown if it does not come.
+#The request was sent, so its response is then waited for in the background and refines the result later.
+#The raw PPI is saved with the result like HrvAnalysisState saves it, the request has the preprocessed one
 class KubiosWaitMsgState(State):
+      def __init__(self, request: dict, fallback: dict, ppi: list):
+            self.request = request
+            self.fallback = fallback
+            self.ppi = ppi
+
       def __enter__(self) -> object:
             self.start_time = time.ticks_ms()
             self.timeout = 10000 #ms
@@ -130,20 +171,23 @@ class KubiosWaitMsgState(State):
       def parse(self, data) -> object:
             try:
                   data = utility.parse_kubios_message(data)
-                  self.state = ViewAnalysisState(data)
-            except: #If data is invalid or has a problem, error state
-                  self.state = ErrorState(['Data could', 'not be parsed'])
+                  self.state = ViewAnalysisState(data, self.ppi)
+            except: #If data is invalid or has a problem, show the local estimate
+                  self.state = ViewAnalysisState(self.fallback, self.ppi)
             return self.state
 
       def run(self, input: int | None) -> object:
-            data = self.hardware.online.listen_kubios()
+            data = self.hardware.online.listen_kubios(self.request['id'])
             if data != None:
                   self.state = self.parse(data)
             elif time.ticks_diff(time.ticks_ms(), self.start_time) > self.timeout:
-                  self.state = ErrorState(['Kubios not', 'reached'])
+                  self.hardware.online.expect_kubios(self.request['id'])
+                  self.state = ViewAnalysisState(self.fallback, self.ppi)
             return self.state
       
 
+#Measures without a connection too, the result is then estimated locally.
+#The runner pings the brokers while measuring so a lost connection is known before sending
 class KubiosState(Measure):
       def __enter__(self) -> object:
             self.start_time = time.ticks_ms()
@@ -152,29 +196,31 @@ class KubiosState(Measure):
             return super().__enter__()
       
       def process_and_send(self) -> object:
-            #Preprocess data for sending
+            #Preprocess data for sending and estimate locally in case kubios is not reached, the raw PPI is saved
             try:
-                  self.PPI = analysis.preprocess_ppi(self.PPI)
-                  data = utility.format_kubios_message(self.PPI)
+                  fallback = analysis.estimate_readiness(self.PPI)
+                  data = utility.format_kubios_message(analysis.preprocess_ppi(self.PPI), fallback["timestamp"])
             except:
                   self.state = ErrorState(['Bad data'])
                   return self.state
-            #Send data to kubios
+            #Send data to kubios, queue it if there is no connection
+            if not self.hardware.online.is_connected():
+                  self.hardware.online.queue_kubios(data)
+                  self.state = ViewAnalysisState(fallback, self.PPI)
+                  return self.state
             try:
                   self.hardware.online.send_kubios(data)
-                  self.state = KubiosWaitMsgState()
+                  self.state = KubiosWaitMsgState(data, fallback, self.PPI)
             except:
-                  self.state = ErrorState(['No connection'])
+                  self.hardware.online.queue_kubios(data)
+                  self.state = ViewAnalysisState(fallback, self.PPI)
             return self.state
 
       def run(self, input: int | None) -> object:
             self.measure(50)
-            self.display_data()
             if not self.peak_appended: #Start counting time when first peak is appended
                   self.start_time = time.ticks_ms()
-            if not self.hardware.online.is_connected():
-                  self.state = ErrorState(['No connection'])
-            elif input == self.hardware.ROT_PUSH:
+            if input == self.hardware.ROT_PUSH:
                   self.state = MenuState()
             elif time.ticks_diff(time.ticks_ms(), self.start_time) > self.timeout:
                   self.hardware.adc.deinit_timer()
@@ -182,63 +228,144 @@ class KubiosState(Measure):
             return self.state
 
 #Special case where init is used to get the file to be read
-class ReadHistoryState(State):
+class ReadHistoryState(ScrollView):
       def __init__(self, filename: str):
             self.file = filename
 
       def __enter__(self) -> object:
             data = self.hardware.historian.read(self.file)
-            self.data = utility.format_data(data)
-            self.hardware.screen.items(self.data, offset=0)
-            self.hardware.screen.set_mode(3)
+            self.show(utility.format_data(data))
             return State.__enter__(self)
 
       def run(self, input: int | None) -> object:
             if input == self.hardware.ROT_PUSH:
                   self.state = MenuState()
+            else:
+                  self.scroll(input)
             return self.state
 
 
+#History is paged, only the rows of the page the cursor is on are read and formatted
 class HistoryState(State):
+      PAGE = 8 #Rows on the screen
+
       def __enter__(self) -> object:
             self.select = 0
-            self.items = self.hardware.historian.contents()
-            self.items.reverse()
-            self.hardware.screen.items(utility.format_filenames(self.items))
-            self.hardware.screen.cursor_pos(self.select)
+            self.page = -1
+            self.length = len(self.hardware.historian)
             self.hardware.screen.set_mode(1)
+            self.show_page()
             return State.__enter__(self)
 
+      def show_page(self):
+            page = self.select // self.PAGE
+            if page != self.page:
+                  self.page = page
+                  self.items = self.hardware.historian.names(page * self.PAGE, self.PAGE)
+                  self.hardware.screen.empty()
+                  self.hardware.screen.items(utility.format_filenames(self.items))
+            self.hardware.screen.cursor_pos(self.select % self.PAGE)
+            return
+
       def run(self, input: int | None) -> object:
-            if not self.items:
+            if not self.length:
                   self.state = ErrorState(['No History'])
             elif input == self.hardware.ROT_PUSH:
-                  self.state = ReadHistoryState(self.items[self.select])
+                  self.state = ReadHistoryState(self.items[self.select % self.PAGE])
             elif input == 1 or input == -1: #Rotary
                   self.select += input
-                  self.select = min(max(0, self.select), len(self.items)-1)
-                  self.hardware.screen.cursor_pos(self.select)
+                  self.select = min(max(0, self.select), self.length-1)
+                  self.show_page()
+            return self.state
+
+
+#Daily and weekly means of HR, RMSSD and SDNN from the history rollups, rotary changes the chart
+class TrendState(State):
+      PERIODS = 32 #Bars, 4 px each
+      VIEWS = (('mean_hr', False), ('rmssd', False), ('sdnn', False), ('mean_hr', True), ('rmssd', True), ('sdnn', True))
+      LABELS = {'mean_hr': 'HR', 'rmssd': 'RMSSD', 'sdnn': 'SDNN'}
+
+      def __enter__(self) -> object:
+            self.select = 0
+            self.hardware.screen.set_mode(6)
+            self.show()
+            return State.__enter__(self)
+
+      def show(self):
+            field, weekly = self.VIEWS[self.select]
+            values = self.hardware.historian.trend(field, weekly, self.PERIODS)
+            self.hardware.screen.chart(f'{self.LABELS[field]} {"WK" if weekly else "DAY"}', values)
+            return
+
+      def run(self, input: int | None) -> object:
+            if not len(self.hardware.historian):
+                  self.state = ErrorState(['No History'])
+            elif input == self.hardware.ROT_PUSH:
+                  self.state = MenuState()
+            elif input == 1 or input == -1: #Rotary
+                  self.select = (self.select + input) % len(self.VIEWS)
+                  self.show()
+            return self.state
+
+
+#Saving and connection diagnostics. Queued measurements are still in RAM and lost on a reset,
+#the flush times show how long the idle states hold the loop saving them
+class StatusState(ScrollView):
+      def __enter__(self) -> object:
+            historian, online = self.hardware.historian, self.hardware.online
+            lines = ['SAVING', f'Queued {historian.queued()}', f'Flush {historian.flush_ms} ms', f'Worst {historian.worst_flush_ms} ms', 'LINK']
+            for name, stats in online.link_stats().items():
+                  rtt = stats["mean_rtt_ms"] if stats else None
+                  lines.append(f'{name} -' if rtt is None else f'{name} {rtt} ms')
+            lines.append(f'Outbox {online.outbox_depth()}')
+            lines.append(f'Requests {online.kubios_depth()}')
+            self.show(lines)
+            return State.__enter__(self)
+
+      def run(self, input: int | None) -> object:
+            if input == self.hardware.ROT_PUSH:
+                  self.state = MenuState()
+            else:
+                  self.scroll(input)
             return self.state
 
 
 class MenuState(State):
       def __enter__(self) -> object:
             self.select = 0
-            self.items = ['MEASURE HR', 'HRV ANALYSIS', 'KUBIOS', 'HISTORY']
-            self.states = [MeasureHrState, HrvAnalysisState, KubiosState, HistoryState]
+            self.items = ['MEASURE HR', 'HRV ANALYSIS', 'KUBIOS', 'HISTORY', 'TRENDS', 'STATUS']
+            self.states = [MeasureHrState, HrvAnalysisState, KubiosState, HistoryState, TrendState, StatusState]
             self.hardware.screen.items(self.items)
             self.hardware.screen.cursor_pos(self.select)
             self.hardware.screen.set_mode(1)
-            if self.hardware.online.is_connected():
-                  self.hardware.led1.on()
-            else:
-                  self.hardware.led1.off()
             return State.__enter__(self)
 
+      #Kubios results for queued requests replace the local estimate saved for the same measurement
+      def refine(self):
+            data = self.hardware.online.listen_queued()
+            if data is None:
+                  return
+            try:
+                  data = utility.parse_kubios_message(data)
+            except:
+                  print('Queued Kubios response could not be parsed')
+                  return
+            if not self.hardware.historian.update(data["timestamp"], data):
+                  print('Measurement of a queued Kubios response is no longer in history')
+            return
+
       def run(self, input: int | None) -> object:
-            if input == self.hardware.SW0 and not self.hardware.online.is_connected():
-                  self.state = ConnectState()
+            self.refine()
+            if input is None: #Idle, save the results written while measuring or viewing, keep the connection up and send what was queued
+                  self.hardware.historian.flush()
+                  if self.hardware.online.supervise():
+                        self.hardware.online.flush_kubios() #Kubios requests made offline
+                        self.hardware.online.drain_local()
+            if input == self.hardware.SW0 and not self.hardware.online.is_connected(): #Reconnect now instead of after the backoff
+                  self.hardware.online.retry_now()
             elif input == self.hardware.ROT_PUSH:
+                  if self.states[self.select] == KubiosState: #Know if kubios answers by the time the measurement is done
+                        self.hardware.online.check_link()
                   self.state = self.states[self.select]()
             elif input == 1 or input == -1: #Rotary
                   self.select += input
@@ -247,22 +374,25 @@ class MenuState(State):
             return self.state
 
 
+#Connection steps are polled so inputs keep working, pressing goes to the menu without connecting
 class ConnectState(State):
       def __enter__(self) -> object:
             self.start_time = time.ticks_ms()
             self.timeout = 15000 #ms
-            self.hardware.rotary.disable() #Rotary must be disabled because online contains a sleep for 20ms, to prevent user fking up
-            self.hardware.screen.items(['Connecting', 'to cosmos'], offset=0)
+            self.hardware.online.start_connect()
+            self.step = None
             self.hardware.screen.set_mode(4)
             return super().__enter__()
       
       def run(self, input: int | None) -> object:
-            if self.hardware.online.connect():
+            if self.step != self.hardware.online.step: #Show the step being done
+                  self.step = self.hardware.online.step
+                  self.hardware.screen.empty()
+                  self.hardware.screen.items(['Connecting', f'{self.step}'], offset=0)
+            if input == self.hardware.ROT_PUSH:
                   self.state = MenuState()
-            elif time.ticks_diff(time.ticks_ms(), self.start_time) > self.timeout:
+            elif self.hardware.online.connect():
+                  self.state = MenuState()
+            elif self.step == 'wifi' and time.ticks_diff(time.ticks_ms(), self.start_time) > self.timeout:
                   self.state = ErrorState(['Wi-Fi not found'])
             return self.state
-      
-      def __exit__(self, exc_type, exc_value, traceback):
-            self.hardware.rotary.enable() #Enable rotary upon exit
-            return
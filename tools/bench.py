@@ -0,0 +1,210 @@
+import sys, gc, json
+import host
+from hardware import HardwareConfig # type: ignore
+from state_machine.measure import Measure # type: ignore
+from lib import analysis, utility, dsp # type: ignore
+from synth import ppg
+
+try:
+      from lib import dsp_native # type: ignore
+except (ImportError, SyntaxError, NotImplementedError):
+      dsp_native = None
+
+'''Benchmarks of the signal processing and analysis hot paths, with python3 or the micropython unix port:
+
+    python3 tools/bench.py                 print the results
+    python3 tools/bench.py --save          store them as the baseline of this python implementation
+    python3 tools/bench.py --compare [0.5]  fail if any is more than 50% slower than the baseline
+
+Correctness is checked by tools/check.py, run it before comparing.
+
+Reported per benchmark: ns/op, alloc B/op and peak B.
+On micropython the allocations are gc.mem_alloc growth with gc disabled, so alloc B/op is all heap an op takes.
+On python3 they come from tracemalloc, alloc B/op is the high-water mark of one op and peak B of the whole run.
+Baselines are per machine, save them again when benchmarking on a different computer.
+The default tolerance is wide because python3 timings of the same code vary by about 25% between processes'''
+
+BASELINE = host.TOOLS + '/bench_baseline.json'
+IMPL = sys.implementation.name
+REPEAT = 5
+
+try:
+      import tracemalloc
+except ImportError:
+      tracemalloc = None
+
+
+#Each benchmark is a setup function returning run(n) that does n ops
+def bench_measure():
+      hardware = HardwareConfig()
+      samples, _ = ppg(seconds=120, seed=3)
+      hardware.adc.load(samples)
+      measure = Measure()
+      def run(n: int):
+            if hardware.adc.pos + n > len(samples):
+                  hardware.adc.load(samples)
+            hardware.adc.feed(n)
+            measure.measure(50)
+      run(1000) #Fill the window so the detector runs
+      return run
+
+#The per sample chain of Measure built from dsp or dsp_native, run(n) pushes n samples and returns the crossings
+def bench_ingest(module):
+      def setup():
+            samples, _ = ppg(seconds=120, seed=4)
+            filter_ = module.PulseFilter(250)
+            window = module.WindowMinMax(500, 'h')
+            detector = module.PeakDetector(500)
+            pos = [0]
+            def run(n: int) -> list:
+                  crossings = []
+                  for _ in range(n):
+                        if pos[0] == len(samples):
+                              pos[0] = 0
+                        filter_.push(samples[pos[0]])
+                        pos[0] += 1
+                        window.push(filter_.filtered)
+                        if detector.push(filter_.envelope):
+                              crossings.append(detector.window.n)
+                  return crossings
+            return run
+      return setup
+
+def bench_analysis(func, beats: int):
+      def setup():
+            _, ppi = ppg(seconds=beats + 10, seed=beats)
+            ppi = ppi[:beats]
+            def run(n: int):
+                  for _ in range(n):
+                        func(ppi)
+            return run
+      return setup
+
+#One beat into the streaming accumulator, what HrvAnalysisState does per accepted PPI
+def bench_accumulator():
+      _, ppi = ppg(seconds=120, seed=5)
+      accumulator = analysis.HrvAccumulator()
+      def run(n: int):
+            for i in range(n):
+                  accumulator.push(ppi[i % len(ppi)])
+      return run
+
+def bench_plot():
+      def run(n: int):
+            for i in range(n):
+                  utility.plot_sample(30000 + (i & 0xFFF), 34000, 0.0105)
+      return run
+
+BENCHMARKS = [('measure.sample', bench_measure, 20000), ('dsp.ingest[python]', bench_ingest(dsp), 20000)]
+if dsp_native is not None:
+      BENCHMARKS.append(('dsp.ingest[native]', bench_ingest(dsp_native), 20000))
+BENCHMARKS.append(('utility.plot_sample', bench_plot, 50000))
+BENCHMARKS.append(('analysis.HrvAccumulator.push', bench_accumulator, 50000))
+for beats in (30, 60, 120):
+      BENCHMARKS.append((f'analysis.full[{beats}]', bench_analysis(analysis.full, beats), 50))
+      BENCHMARKS.append((f'analysis.time_domain[{beats}]', bench_analysis(analysis.time_domain, beats), 1000))
+      BENCHMARKS.append((f'analysis.preprocess_ppi[{beats}]', bench_analysis(analysis.preprocess_ppi, beats), 1000))
+      BENCHMARKS.append((f'analysis.rmssd[{beats}]', bench_analysis(analysis.rmssd, beats), 1000))
+      BENCHMARKS.append((f'analysis.sdnn[{beats}]', bench_analysis(analysis.sdnn, beats), 1000))
+      BENCHMARKS.append((f'analysis.frequency[{beats}]', bench_analysis(analysis.frequency, beats), 50))
+
+
+def time_run(run, ops: int) -> int:
+      best = None
+      for _ in range(REPEAT):
+            gc.collect()
+            start = host.now()
+            run(ops)
+            elapsed = host.elapsed_ns(start)
+            if best is None or elapsed < best:
+                  best = elapsed
+      return best // ops
+
+def alloc_run(run, ops: int) -> tuple[int, int]:
+      gc.collect()
+      if tracemalloc is None: #micropython
+            gc.disable()
+            before = gc.mem_alloc()
+            run(ops)
+            total = gc.mem_alloc() - before
+            gc.enable()
+            return total // ops, total
+      tracemalloc.start()
+      base = tracemalloc.get_traced_memory()[0]
+      run(1)
+      per_op = tracemalloc.get_traced_memory()[1] - base
+      tracemalloc.reset_peak()
+      run(ops)
+      peak = tracemalloc.get_traced_memory()[1] - base
+      tracemalloc.stop()
+      return per_op, peak
+
+def run_one(name: str) -> int:
+      for name_, setup, ops in BENCHMARKS:
+            if name_ == name:
+                  return time_run(setup(), ops)
+      raise ValueError(f'No benchmark {name}')
+
+def run_all() -> dict:
+      results = {}
+      print(f'{"benchmark":<32} {"ns/op":>10} {"alloc B/op":>11} {"peak B":>9}')
+      for name, setup, ops in BENCHMARKS:
+            run = setup()
+            ns = time_run(run, ops)
+            per_op, peak = alloc_run(run, ops)
+            results[name] = ns
+            print(f'{name:<32} {ns:>10} {per_op:>11} {peak:>9}')
+      return results
+
+
+def load_baseline() -> dict:
+      try:
+            with open(BASELINE, 'r') as file:
+                  return json.load(file)
+      except OSError:
+            return {}
+
+def save_baseline(results: dict):
+      baseline = load_baseline()
+      baseline[IMPL] = results
+      with open(BASELINE, 'w') as file:
+            json.dump(baseline, file)
+      print(f'Baseline for {IMPL} saved')
+      return
+
+#Returns the names of the benchmarks slower than the baseline by more than tolerance.
+#A slow result is timed again before it counts, so one noisy run on a busy PC does not fail the comparison
+def compare(results: dict, tolerance: float, retries: int = 2) -> list:
+      baseline = load_baseline().get(IMPL, {})
+      slower = []
+      for name in results:
+            if name not in baseline:
+                  continue
+            for _ in range(retries):
+                  if results[name] <= baseline[name] * (1 + tolerance):
+                        break
+                  results[name] = min(results[name], run_one(name))
+            ratio = results[name] / max(baseline[name], 1)
+            if ratio > 1 + tolerance:
+                  slower.append(name)
+                  print(f'SLOWER {name}: {results[name]} ns/op, baseline {baseline[name]} ns/op ({ratio:.2f}x)')
+      return slower
+
+
+def main():
+      args = sys.argv[1:]
+      if dsp_native is None:
+            print('dsp_native not available on this port, benchmarking the python build only')
+      results = run_all()
+      if '--save' in args:
+            save_baseline(results)
+      if '--compare' in args:
+            i = args.index('--compare') + 1
+            tolerance = float(args[i]) if i < len(args) else 0.5
+            if compare(results, tolerance):
+                  sys.exit(1)
+            print(f'No benchmark slower than the {IMPL} baseline by more than {round(tolerance * 100)}%')
+      return
+
+if __name__ == '__main__':
+      main()
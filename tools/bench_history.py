@@ -0,0 +1,100 @@
+import sys, os
+import host
+import ujson # type: ignore
+from historian import History # type: ignore
+
+'''Benchmark of saving measurements, run with python3 or the micropython unix port, or on the Pico:
+    python3 tools/bench_history.py [folder]
+
+The folder is made in the current directory by default, pulsecheck_bench, and may be given as a path.
+
+Writes the same measurements with the old one json file per measurement history
+(new file, listdir and sort, remove the oldest) and with the History record log.
+Prints the write latency and the flash blocks the history takes. On the Pico the blocks
+are measured from the filesystem, elsewhere they are counted from the file sizes
+with the 4 kB LittleFS block of the Pico, so every small file takes at least a block'''
+
+WRITES = 50
+BLOCK = 4096
+SAMPLE = {
+            "id": 0, "timestamp": 0, "mean_hr": 71, "mean_ppi": 844, "rmssd": 44, "sdnn": 27,
+            "pnn50": 41, "nn50": 16, "sd1": 32, "sd2": 21, "min_hr": 67, "max_hr": 75,
+            "lf": 35, "hf": 136, "lf_hf": 0.26, "tp": 176
+      }
+
+
+def free_blocks() -> int | None:
+      if sys.platform != 'rp2':
+            return None
+      return os.statvfs('/')[3]
+
+def blocks(folder: str) -> int:
+      total = 0
+      for file in os.listdir(folder):
+            size = os.stat(f'{folder}/{file}')[6]
+            total += max(1, (size + BLOCK - 1) // BLOCK)
+      return total
+
+def clean(folder: str):
+      for file in os.listdir(folder):
+            os.remove(f'{folder}/{file}')
+      return
+
+
+#The historian before the record log
+def write_files(folder: str, data: dict):
+      files = os.listdir(folder)
+      if len(files) > 6:
+            files.sort()
+            os.remove(f'{folder}/{files[0]}')
+      with open(f'{folder}/meas_{data["timestamp"]}', 'x') as f:
+            ujson.dump(data, f)
+      return
+
+#Flushed right away so the flash write is timed, on the device it happens later when idle
+def write_log(history: History, data: dict):
+      history.write(data)
+      history.flush()
+      return
+
+
+def run(name: str, write, target, folder: str):
+      free = free_blocks()
+      worst, total = 0, 0
+      for i in range(WRITES):
+            data = dict(SAMPLE)
+            data["id"] = data["timestamp"] = 1000 + i
+            start = host.now()
+            write(target, data)
+            took = host.elapsed_ns(start)
+            total += took
+            worst = max(worst, took)
+      used = blocks(folder) if free is None else free - free_blocks()
+      print(f'{name:<12}{total // WRITES // 1000:>10}{worst // 1000:>10}{used:>8}')
+      return
+
+
+def main():
+      folder = sys.argv[1] if len(sys.argv) > 1 else 'pulsecheck_bench' #Relative so it works on the Pico too
+      try:
+            os.mkdir(folder)
+      except OSError:
+            pass
+      os.chdir(folder)
+      for sub in ('files', 'hist'):
+            if sub not in os.listdir():
+                  os.mkdir(sub)
+      clean('files')
+      clean('hist')
+
+      print(f'{WRITES} writes, json files keep 7 measurements and the log all of them')
+      print(f'{"":<12}{"mean us":>10}{"worst us":>10}{"blocks":>8}')
+      run('json files', write_files, 'files', 'files')
+      history = History()
+      run('record log', write_log, history, 'hist')
+      clean('files')
+      history.empty()
+      return
+
+if __name__ == '__main__':
+      main()
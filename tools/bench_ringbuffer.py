@@ -0,0 +1,39 @@
+import host
+from dsp import RingBuffer # type: ignore
+
+'''Host side benchmark of the sample window, run with python3 or the micropython unix port:
+    python3 tools/bench_ringbuffer.py
+
+Pushes samples into the old list window (append + del [0]) and into the RingBuffer
+and prints the cost per sample for growing window sizes. The ring buffer should stay flat'''
+
+SAMPLES = 20000
+WINDOWS = (250, 500, 1000, 2000, 4000, 8000)
+
+
+def bench_list(size: int) -> int:
+      samples = [0] * size
+      start = host.now()
+      for i in range(SAMPLES):
+            samples.append(i & 0xFFFF)
+            del samples[0]
+      return host.elapsed_ns(start) // SAMPLES
+
+def bench_ring(size: int) -> int:
+      samples = RingBuffer(size)
+      for i in range(size):
+            samples.push(0)
+      start = host.now()
+      for i in range(SAMPLES):
+            samples.push(i & 0xFFFF)
+      return host.elapsed_ns(start) // SAMPLES
+
+
+def main():
+      print(f'{"window":>8} {"list ns/sample":>16} {"ring ns/sample":>16}')
+      for size in WINDOWS:
+            print(f'{size:>8} {bench_list(size):>16} {bench_ring(size):>16}')
+      return
+
+if __name__ == '__main__':
+      main()
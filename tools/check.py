@@ -0,0 +1,45 @@
+import sys
+import host
+from lib import analysis, dsp # type: ignore
+from bench import bench_ingest, dsp_native
+
+'''Correctness checks of the host tools, with python3 or the micropython unix port:
+
+    python3 tools/check.py
+
+Exits with 1 if any check fails. Run it before benchmarking, bench.py only times the code'''
+
+
+#The native build must find the same crossings as the reference
+def check_native() -> bool:
+      if dsp_native is None:
+            print('dsp_native not available on this port, skipped')
+            return True
+      same = bench_ingest(dsp)()(30000) == bench_ingest(dsp_native)()(30000)
+      print('dsp_native matches dsp' if same else 'dsp_native DIFFERS from dsp')
+      return same
+
+#Missed beats at the start must not anchor the accumulator, it has to agree with analysis.full
+def check_accumulator() -> bool:
+      ppi = [1700, 1700] + [850 + (i * 7) % 41 - 20 for i in range(33)]
+      accumulator = analysis.HrvAccumulator()
+      for rr in ppi:
+            accumulator.push(rr)
+      streaming, results = accumulator.results(), analysis.full(ppi)
+      same = all(streaming[key] == results[key] for key in ('mean_hr', 'rmssd', 'sdnn'))
+      print('HrvAccumulator matches analysis.full' if same else f'HrvAccumulator DIFFERS from analysis.full: {streaming} {results}')
+      return same
+
+CHECKS = [check_native, check_accumulator]
+
+
+def main():
+      failed = [check.__name__ for check in CHECKS if not check()]
+      if failed:
+            print(f'FAILED: {", ".join(failed)}')
+            sys.exit(1)
+      print('All checks passed')
+      return
+
+if __name__ == '__main__':
+      main()
@@ -0,0 +1,57 @@
+import sys, time
+from array import array
+
+'''Support for running the PulseCheck code on a PC with python3 or the micropython unix port.
+Importing this module puts the simulated hardware and the pulsecheck folders on the path,
+so the device modules can be imported as they are:
+
+    import host
+    from state_machine.measure import Measure
+                                                '''
+
+TOOLS = __file__.rsplit('/', 1)[0] if '/' in __file__ else '.'
+ROOT = TOOLS + '/..'
+#Simulated hardware first so it shadows pulsecheck/hardware.py
+for path in (ROOT + '/pulsecheck/lib', ROOT + '/pulsecheck', TOOLS + '/sim'):
+      if path not in sys.path:
+            sys.path.insert(0, path)
+
+#CPython does not have the micropython ticks functions
+if not hasattr(time, 'ticks_ms'):
+      _start = time.perf_counter_ns()
+      time.ticks_ms = lambda: (time.perf_counter_ns() - _start) // 1000000
+      time.ticks_us = lambda: (time.perf_counter_ns() - _start) // 1000
+      time.ticks_diff = lambda new, old: new - old
+      time.ticks_add = lambda ticks, delta: ticks + delta
+      time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+
+#Same for the micropython json module name
+if 'ujson' not in sys.modules:
+      try:
+            import ujson
+      except ImportError:
+            import json
+            sys.modules['ujson'] = json
+
+
+#Nanosecond timer for measuring throughput, on micropython the resolution is 1 us
+def now() -> int:
+      if hasattr(time, 'perf_counter_ns'):
+            return time.perf_counter_ns()
+      return time.ticks_us()
+
+def elapsed_ns(start: int) -> int:
+      if hasattr(time, 'perf_counter_ns'):
+            return time.perf_counter_ns() - start
+      return time.ticks_diff(time.ticks_us(), start) * 1000
+
+
+#Read an ADC capture file, one integer per line like the pico-lib filefifo data
+def load_recording(path: str) -> array:
+      samples = array('H')
+      with open(path, 'r') as file:
+            for line in file:
+                  line = line.strip()
+                  if line and line[0] in '0123456789':
+                        samples.append(int(line))
+      return samples
@@ -0,0 +1,82 @@
+import sys
+import host
+from hardware import HardwareConfig # type: ignore
+from state_machine.measure import Measure # type: ignore
+from state_machine.states import HrvAnalysisState # type: ignore
+from lib import analysis # type: ignore
+
+'''Offline replay of a recorded ADC capture through the real Measure signal path and the local analysis.
+Prints both analysis.full over the PPI list and the HrvAccumulator results HrvAnalysisState shows.
+Runs as fast as the PC can, with python3 or the micropython unix port:
+
+    python3 tools/replay.py capture.txt [--hz 250] [--batch 25] [--hrv]
+
+--batch is how many samples arrive between two state machine passes (25 = a 100 ms pass at 250 Hz)
+--hrv stops 30 seconds after the first accepted beat and keeps as many PPI as HrvAnalysisState'''
+
+
+#Run the samples through Measure, returns the detected PPI, analysis results and throughput
+def replay(samples, hz: int = 250, batch: int = 25, hrv: bool = False) -> dict:
+      hardware = HardwareConfig()
+      hardware.ADC_HZ = hz
+      hardware.adc.load(samples)
+      max_ppi = HrvAnalysisState.MAX_PPI if hrv else len(samples)
+      first_beat = None
+
+      measure = Measure()
+      accumulator = analysis.HrvAccumulator()
+      measure.on_ppi = accumulator.push
+      start = host.now()
+      while not hardware.adc.exhausted():
+            hardware.adc.feed(batch)
+            measure.measure(max_ppi)
+            if first_beat is None and measure.peak_appended:
+                  first_beat = measure.sample_num
+            if hrv and first_beat is not None and measure.sample_num - first_beat >= 30 * hz:
+                  break
+      elapsed = host.elapsed_ns(start)
+      measure.__exit__(None, None, None)
+
+      #Same as HrvAnalysisState.analysis, any failure is bad data
+      try:
+            results = analysis.full(measure.PPI)
+      except Exception:
+            results = None
+      try:
+            streaming = accumulator.results()
+      except Exception:
+            streaming = None
+      try:
+            streaming.update(analysis.frequency(accumulator.beats))
+      except (AttributeError, ValueError):
+            pass
+      return {
+                  "ppi": measure.PPI,
+                  "analysis": results,
+                  "streaming": streaming,
+                  "samples": measure.sample_num,
+                  "samples_per_s": round(measure.sample_num * 1e9 / max(elapsed, 1)),
+                  "realtime_x": round(measure.sample_num * 1e9 / hz / max(elapsed, 1), 1)
+            }
+
+
+def main():
+      args = sys.argv[1:]
+      if not args or args[0].startswith('--'):
+            print('usage: replay.py capture.txt [--hz 250] [--batch 25] [--hrv]')
+            return
+      hz = int(args[args.index('--hz') + 1]) if '--hz' in args else 250
+      batch = int(args[args.index('--batch') + 1]) if '--batch' in args else 25
+
+      result = replay(host.load_recording(args[0]), hz, batch, '--hrv' in args)
+      print(f'PPI ({len(result["ppi"])}): {result["ppi"]}')
+      if result['analysis'] is None:
+            print('Analysis: Bad Data')
+      else:
+            print(f'Analysis: {result["analysis"]}')
+      print(f'Streaming: {result["streaming"]}')
+      print(f'{result["samples"]} samples, {result["samples_per_s"]} samples/s, {result["realtime_x"]}x real time')
+      return
+
+if __name__ == '__main__':
+      main()
@@ -0,0 +1,220 @@
+from array import array
+'''Simulated HardwareConfig for running the state machine on a PC.
+It replaces pulsecheck/hardware.py when the tools folder is on the path (see tools/host.py),
+the adc is fed from a recording instead of the Piotimer isr and the screen draws nothing'''
+
+#Fifo interface of Isr_fifo, samples become available when the replay feeds them
+class ReplayAdc:
+      def __init__(self):
+            self.data = array('H')
+            self.pos, self.end = 0, 0
+            self.hz = 0
+
+      def load(self, samples: array):
+            self.data = samples
+            self.pos, self.end = 0, 0
+            return
+
+      #Make the next n samples available, like the timer isr does during one state machine pass
+      def feed(self, n: int):
+            self.end = min(self.end + n, len(self.data))
+            return
+
+      def exhausted(self) -> bool:
+            return self.pos >= len(self.data)
+
+      def empty(self) -> bool:
+            return self.pos >= self.end
+
+      def get(self) -> int:
+            if self.pos >= self.end:
+                  raise RuntimeError('Fifo is empty')
+            self.pos += 1
+            return self.data[self.pos - 1]
+
+      def dropped(self) -> int:
+            return 0
+
+      def init_timer(self, hz=250):
+            self.hz = hz
+            return
+
+      def deinit_timer(self):
+            return
+
+
+#Same interface as lib.peripherals.Screen without drawing anything
+class NullScreen:
+      width = 128
+      heigth = 64
+
+      def update(self):
+            return
+
+      def hr_plot_pos(self, x: int, y: int):
+            return
+
+      def hr_bpm(self, bpm: int):
+            return
+
+      def hrv_live(self, rmssd: int, sdnn: int):
+            return
+
+      def cursor_pos(self, pos: int):
+            return
+
+      def items(self, items_: list, offset: int = 10):
+            return
+
+      def empty(self):
+            return
+
+      def ppi(self):
+            return
+
+      def chart(self, title: str, values: list):
+            return
+
+      def set_mode(self, mode: int):
+            return
+
+
+#Input fifo like lib.peripherals.WakingFifo, the simulation puts the inputs
+class SimFifo:
+      def __init__(self):
+            self.data = []
+            self.flag = None
+
+      def put(self, value: int):
+            self.data.append(value)
+            if self.flag is not None:
+                  self.flag.set()
+            return
+
+      def empty(self) -> bool:
+            return not self.data
+
+      def get(self) -> int:
+            return self.data.pop(0)
+
+
+#Offline Online, every connection is done at once and nothing is sent
+class NullOnline:
+      connected = False
+      step = 'done'
+
+      def start_connect(self):
+            return
+
+      def connect(self) -> bool:
+            return True
+
+      def is_connected(self) -> bool:
+            return False
+
+      def poll(self) -> bool:
+            return False
+
+      def keepalive(self) -> bool:
+            return False
+
+      def supervise(self) -> bool:
+            return False
+
+      def retry_now(self):
+            return
+
+      def on_event(self, callback):
+            return
+
+      def check_link(self):
+            return
+
+      def link_stats(self) -> dict:
+            return {"local": None, "kubios": None}
+
+      def listen_kubios(self, id: int):
+            return None
+
+      def listen_queued(self):
+            return None
+
+      def flush_kubios(self) -> int:
+            return 0
+
+      def queue_kubios(self, data: dict):
+            return
+
+      def expect_kubios(self, id: int):
+            return
+
+      def queue_local(self, data: dict):
+            return
+
+      def drain_local(self, budget_ms: int = 20) -> int:
+            return 0
+
+      def outbox_depth(self) -> int:
+            return 0
+
+      def kubios_depth(self) -> int:
+            return 0
+
+
+class NullLed:
+      def on(self):
+            return
+
+      def off(self):
+            return
+
+
+#History that keeps nothing, so a replay does not write files
+class NullHistory:
+      flush_ms, worst_flush_ms = 0, 0
+
+      def write(self, data: dict, ppi: list | None = None):
+            return
+
+      def flush(self):
+            return
+
+      def queued(self) -> int:
+            return 0
+
+      def update(self, stamp: int, data: dict) -> bool:
+            return False
+
+      def __len__(self) -> int:
+            return 0
+
+
+class HardwareConfig:
+      _instance = None
+      _initted = False
+
+      def __new__(cls):
+            if cls._instance is None:
+                  cls._instance = super().__new__(cls)
+            return cls._instance
+
+      def __init__(self):
+            if self._initted:
+                  return
+            self._initted = True
+
+            #Same pin numbers as the device, states compare inputs against these
+            self.ROTA = 10
+            self.ROTB = 11
+            self.ROT_PUSH = 12
+            self.ADC = 26
+            self.SW0 = 7
+
+            self.screen = NullScreen()
+            self.historian = NullHistory()
+            self.fifo = SimFifo()
+            self.online = NullOnline()
+            self.led1 = NullLed()
+            self.ADC_HZ = 250
+            self.WORST_PASS_MS = 120
+            self.adc = ReplayAdc()
@@ -0,0 +1,128 @@
+import sys, time
+import host
+try:
+      import asyncio
+except ImportError:
+      import uasyncio as asyncio # type: ignore
+from hardware import HardwareConfig, NullScreen # type: ignore
+from state_machine.states import MenuState, MeasureHrState # type: ignore
+from runtime import AsyncPulseCheck # type: ignore
+import synth
+
+'''Runs the states with the polling loop of main.py and with the asyncio runtime on simulated peripherals
+and compares them, with python3 or the micropython unix port:
+
+    python3 tools/sim_runtime.py [seconds]
+
+Samples arrive in real time at 250 Hz from a synthetic PPG and rotary turns every 200 ms, like the irqs would.
+Busy is the share of the time spent in the state run calls, the polling loop is never idle so the rest
+of its time goes to polling. Latency is from an input to the menu cursor moving, on a PC the polling loop
+reacts faster because it spins freely, device numbers have not been measured'''
+
+INPUT_MS = 200
+
+
+#Screen that records when the cursor moved, that is when the menu reacted to an input
+class RecordingScreen(NullScreen):
+      def __init__(self):
+            self.moves = []
+
+      def cursor_pos(self, pos: int):
+            self.moves.append(time.ticks_us())
+            return
+
+
+#Feeds the adc and the inputs by the time passed like the irqs do
+class Feeder:
+      def __init__(self, hardware: HardwareConfig, inputs: bool):
+            self.hardware = hardware
+            self.inputs = inputs
+            self.start = time.ticks_ms()
+            self.fed = 0
+            self.next_input = INPUT_MS
+            self.direction = 1
+            self.puts = []
+
+      def feed(self):
+            elapsed = time.ticks_diff(time.ticks_ms(), self.start)
+            due = elapsed * self.hardware.ADC_HZ // 1000
+            if due > self.fed:
+                  self.hardware.adc.feed(due - self.fed)
+                  self.fed = due
+            if self.inputs and elapsed >= self.next_input:
+                  self.next_input += INPUT_MS
+                  self.direction = -self.direction
+                  self.puts.append(time.ticks_us())
+                  self.hardware.fifo.put(self.direction)
+            return elapsed
+
+
+def setup(state_class, inputs: bool) -> tuple:
+      hardware = HardwareConfig()
+      hardware.adc.load(synth.ppg(30, hardware.ADC_HZ, 70, 1)[0])
+      hardware.fifo.data = []
+      hardware.screen = RecordingScreen()
+      return hardware, state_class(), Feeder(hardware, inputs)
+
+
+#Same loop as PulseCheck.execute in main.py, with a deadline
+def run_polling(state_class, seconds: float, inputs: bool) -> dict:
+      hardware, state, feeder = setup(state_class, inputs)
+      hardware.fifo.flag = None
+      runs, busy = 0, 0
+      next_state = state
+      while feeder.feed() < seconds * 1000:
+            with next_state as current:
+                  while next_state == current and feeder.feed() < seconds * 1000:
+                        input = None if hardware.fifo.empty() else hardware.fifo.get()
+                        hardware.online.keepalive()
+                        start = time.ticks_us()
+                        next_state = current.run(input)
+                        busy += time.ticks_diff(time.ticks_us(), start)
+                        runs += 1
+      return result(hardware, feeder, runs, busy, seconds)
+
+def run_async(state_class, seconds: float, inputs: bool) -> dict:
+      hardware, state, feeder = setup(state_class, inputs)
+      runtime = AsyncPulseCheck(state)
+
+      async def irqs():
+            while feeder.feed() < seconds * 1000:
+                  await asyncio.sleep(0.001)
+
+      async def main():
+            task = asyncio.create_task(runtime.main())
+            await irqs()
+            task.cancel()
+
+      asyncio.run(main())
+      return result(hardware, feeder, runtime.runs, runtime.busy_us, seconds)
+
+def result(hardware: HardwareConfig, feeder: Feeder, runs: int, busy: int, seconds: float) -> dict:
+      latencies = []
+      moves = hardware.screen.moves
+      for put in feeder.puts:
+            after = [move for move in moves if time.ticks_diff(move, put) >= 0]
+            if after:
+                  latencies.append(time.ticks_diff(after[0], put))
+      return {
+                  "runs_per_s": round(runs / seconds),
+                  "busy_pct": round(busy / (seconds * 10000), 1),
+                  "latency_us": round(sum(latencies) / len(latencies)) if latencies else None,
+                  "worst_us": max(latencies) if latencies else None
+            }
+
+
+def main():
+      seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+      print(f'{"":<22}{"runs/s":>10}{"busy %":>8}{"latency us":>12}{"worst us":>10}')
+      for name, state_class, inputs in (('menu', MenuState, True), ('measuring', MeasureHrState, False)):
+            for runtime, run in (('polling', run_polling), ('asyncio', run_async)):
+                  r = run(state_class, seconds, inputs)
+                  latency = '-' if r["latency_us"] is None else r["latency_us"]
+                  worst = '-' if r["worst_us"] is None else r["worst_us"]
+                  print(f'{name + " " + runtime:<22}{r["runs_per_s"]:>10}{r["busy_pct"]:>8}{latency:>12}{worst:>10}')
+      return
+
+if __name__ == '__main__':
+      main()
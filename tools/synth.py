@@ -0,0 +1,56 @@
+import sys, math
+from array import array
+
+'''Synthetic PPG recordings for the host tools, deterministic on python3 and micropython.
+Can be written to a capture file in the filefifo format:
+    python3 tools/synth.py capture.txt [seconds] [bpm] [seed]'''
+
+#Small LCG so the same seed gives the same signal everywhere
+class Random:
+      def __init__(self, seed: int):
+            self.state = seed & 0x7FFFFFFF
+
+      def random(self) -> float:
+            self.state = (1103515245 * self.state + 12345) & 0x7FFFFFFF
+            return self.state / 0x80000000
+
+      #Roughly normal, sum of uniforms
+      def gauss(self, sigma: float) -> float:
+            return (self.random() + self.random() + self.random() + self.random() - 2) * sigma * 1.732
+
+
+#Returns the samples and the true beat to beat intervals in ms
+def ppg(seconds: int = 60, hz: int = 250, bpm: int = 70, seed: int = 1,
+        noise: int = 300, wander: int = 2000, variability: float = 0.08) -> tuple:
+      rand = Random(seed)
+      samples, intervals = array('H'), []
+      mean_period = 60 / bpm
+      period = mean_period
+      phase = 0
+      for n in range(seconds * hz):
+            phase += 1 / hz
+            if phase >= period:
+                  phase -= period
+                  intervals.append(round(period * 1000))
+                  period = mean_period * (1 + variability * (2 * rand.random() - 1))
+            x = phase / period
+            pulse = math.exp(-((x - 0.25) / 0.08)**2) + 0.4 * math.exp(-((x - 0.55) / 0.1)**2)
+            value = 30000 + 8000 * pulse + wander * math.sin(2 * math.pi * 0.15 * n / hz) + rand.gauss(noise)
+            samples.append(min(max(0, int(value)), 65535))
+      return samples, intervals
+
+
+def main():
+      if len(sys.argv) < 2:
+            print('usage: synth.py capture.txt [seconds] [bpm] [seed]')
+            return
+      args = [int(arg) for arg in sys.argv[2:]] + [60, 70, 1][len(sys.argv) - 2:]
+      samples, intervals = ppg(seconds=args[0], bpm=args[1], seed=args[2])
+      with open(sys.argv[1], 'w') as file:
+            for sample in samples:
+                  file.write(f'{sample}\n')
+      print(f'{len(samples)} samples, {len(intervals)} beats, mean PPI {sum(intervals) / len(intervals):.1f} ms')
+      return
+
+if __name__ == '__main__':
+      main()